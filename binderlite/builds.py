@@ -0,0 +1,501 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from repo2jupyterlite import worker
+from repoproviders.utils import Cache
+
+from .metrics import BUILD_COUNT, BUILD_PHASE_TIME, span
+
+log = logging
+
+
+class BuildFailed(Exception):
+    """
+    Raised when a repo2jupyterlite build for a slug does not succeed
+    """
+
+
+class BuildQueueFull(Exception):
+    """
+    Raised when all build slots are busy and the build queue is full
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Build queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BuildScheduler:
+    """
+    Limit the number of concurrently running builds.
+
+    Each build is a clone plus a full JupyterLite environment build, so
+    running an unbounded number of them at once exhausts CPU, memory and
+    disk. Builds beyond max_running wait in a bounded FIFO queue, and builds
+    beyond that are rejected with BuildQueueFull.
+    """
+
+    def __init__(self, max_running, max_queued):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.running = 0
+        # Futures of builds waiting for a slot, in FIFO order
+        self.waiters = deque()
+
+        # Stats, exposed via get_stats()
+        self.started_count = 0
+        self.rejected_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_run_time = 0.0
+        self.finished_count = 0
+
+    def estimate_retry_after(self):
+        """
+        Estimate how many seconds a rejected client should wait before retrying
+        """
+        if self.finished_count:
+            avg_run_time = self.total_run_time / self.finished_count
+        else:
+            avg_run_time = 60
+        waves = 1 + len(self.waiters) // self.max_running
+        return max(10, int(avg_run_time * waves))
+
+    def reserve(self):
+        """
+        Reserve a build slot, or a place in the queue, for a build starting now.
+
+        Returns a future that is done once the build has a slot, to be passed
+        to slot() - or to cancel() if the build turns out not to be needed.
+        Raises BuildQueueFull if there is no free slot and no room in the queue.
+
+        Reserving is synchronous, so builds started in the same event loop
+        tick can't all see the same free capacity.
+        """
+        reservation = asyncio.get_running_loop().create_future()
+        if self.running < self.max_running and not self.waiters:
+            self.running += 1
+            reservation.set_result(None)
+        elif len(self.waiters) >= self.max_queued:
+            self.rejected_count += 1
+            raise BuildQueueFull(self.estimate_retry_after())
+        else:
+            self.waiters.append(reservation)
+        return reservation
+
+    def cancel(self, reservation):
+        """
+        Give up a reservation from reserve() without using it
+        """
+        if reservation.done() and not reservation.cancelled():
+            # We were handed a slot
+            self._release()
+        else:
+            reservation.cancel()
+            if reservation in self.waiters:
+                self.waiters.remove(reservation)
+
+    @asynccontextmanager
+    async def slot(self, reservation=None):
+        """
+        Wait for a build slot, and hold it for the duration of the with block.
+
+        Uses reservation from reserve() if given. Otherwise raises
+        BuildQueueFull if there is no free slot and no room in the queue.
+        """
+        queued_at = time.perf_counter()
+        if reservation is None:
+            reservation = self.reserve()
+        try:
+            # _release hands its slot over to us directly, so running
+            # is not decremented and incremented again
+            await reservation
+        except asyncio.CancelledError:
+            self.cancel(reservation)
+            raise
+
+        started_at = time.perf_counter()
+        wait_time = started_at - queued_at
+        self.started_count += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            yield
+        finally:
+            self.finished_count += 1
+            self.total_run_time += time.perf_counter() - started_at
+            self._release()
+
+    def _release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+    def get_stats(self):
+        return {
+            "slots": self.max_running,
+            "slots_busy": self.running,
+            "queue_size": self.max_queued,
+            "queue_depth": len(self.waiters),
+            "started": self.started_count,
+            "finished": self.finished_count,
+            "rejected": self.rejected_count,
+            "average_wait_seconds": (
+                self.total_wait_time / self.started_count if self.started_count else 0
+            ),
+            "max_wait_seconds": self.max_wait_time,
+        }
+
+
+class BuilderPool:
+    """
+    Pool of long-lived repo2jupyterlite builder processes.
+
+    Builder processes import jupyterlite and friends once when they start,
+    instead of once per build. See repo2jupyterlite.worker.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = self._make_executor()
+
+    def _make_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            # Don't fork the server, with its event loop and threads
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=worker.initialize,
+        )
+
+    def warm(self):
+        """
+        Start all builder processes now, so the first builds don't wait for them
+        """
+        for _ in range(self.max_workers):
+            self.executor.submit(os.getpid)
+
+    async def run_build(
+        self, build, output_dir, report_path, base_build=None, record_inputs=True
+    ):
+        """
+        Run build in a builder process, streaming its log lines into build
+
+        A JSON report of the build is written to report_path. If base_build
+        is given, the build starts from it where possible. If record_inputs
+        is False, the build can't be the base of later ones.
+        """
+        loop = asyncio.get_running_loop()
+        # So we know whether a broken executor has already been replaced
+        executor = self.executor
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".log") as log_file:
+                future = loop.run_in_executor(
+                    executor,
+                    worker.run_build,
+                    build.repo,
+                    build.ref,
+                    str(output_dir),
+                    log_file.name,
+                    str(report_path),
+                    str(base_build) if base_build else None,
+                    None,
+                    record_inputs,
+                )
+                with open(log_file.name, "rb") as f:
+                    pending = b""
+                    while True:
+                        done = future.done()
+                        pending += f.read()
+                        *lines, pending = pending.split(b"\n")
+                        if done and pending:
+                            lines.append(pending)
+                        for line in lines:
+                            line = line.decode("utf-8", "replace").rstrip()
+                            build.append_log(line)
+                        if done:
+                            break
+                        await asyncio.wait([future], timeout=0.5)
+                await future
+        except BrokenProcessPool:
+            # A builder process died (OOM killed, for example), which makes
+            # the whole executor unusable - submitting to it too. Start over
+            # with a new one, unless another build it broke already did.
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = self._make_executor()
+            raise BuildFailed(f"Builder process died while building {build.slug}")
+
+
+class Build:
+    """
+    A single repo2jupyterlite build of a slug, and its progress.
+
+    Log lines from the build are kept, so clients can follow a build
+    from the start no matter when they join.
+    """
+
+    def __init__(self, slug, repo, ref):
+        self.id = uuid.uuid4().hex
+        self.slug = slug
+        self.repo = repo
+        self.ref = ref
+        self.status = "queued"
+        self.error = None
+        self.log_lines = []
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        # Slug of the published build this one is incrementally built from
+        self.base_slug = None
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status in ("succeeded", "failed")
+
+    def _notify(self):
+        # Wake up everyone waiting on the current event, and give
+        # future waiters a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append_log(self, line):
+        self.log_lines.append(line)
+        self._notify()
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        if self.done:
+            self.finished_at = time.time()
+        self._notify()
+
+    async def follow(self):
+        """
+        Yield (kind, data) tuples of log lines and status changes as they happen.
+
+        Starts with all log lines produced so far, and stops after the build
+        is done.
+        """
+        sent_lines = 0
+        sent_status = None
+        while True:
+            changed = self._changed
+            while sent_lines < len(self.log_lines):
+                yield "log", self.log_lines[sent_lines]
+                sent_lines += 1
+            if self.status != sent_status:
+                sent_status = self.status
+                yield "status", self.to_dict()
+            if self.done:
+                return
+            await changed.wait()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "slug": self.slug,
+            "repo": self.repo,
+            "ref": self.ref,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BuildManager:
+    """
+    Run repo2jupyterlite builds, coalescing concurrent requests per slug.
+
+    When a link gets shared, many browsers request the same slug at the
+    same time. Only the first request starts a build - everyone else joins
+    the same in-flight build, and sees the same success or failure.
+
+    A JSON report of where the time and memory of each build went (see
+    repo2jupyterlite.report) is kept in reports_dir, as <slug>.json.
+    """
+
+    def __init__(self, publisher, scheduler=None, builder_pool=None, reports_dir=None):
+        self.publisher = publisher
+        if reports_dir is None:
+            reports_dir = os.environ.get("BINDERLITE_REPORTS_DIR", "reports")
+        self.reports_dir = Path(reports_dir)
+        if scheduler is None:
+            scheduler = BuildScheduler(
+                max_running=int(
+                    os.environ.get("BINDERLITE_MAX_RUNNING_BUILDS", os.cpu_count() or 1)
+                ),
+                max_queued=int(os.environ.get("BINDERLITE_MAX_QUEUED_BUILDS", 64)),
+            )
+        self.scheduler = scheduler
+        if (
+            builder_pool is None
+            and os.environ.get("BINDERLITE_BUILDER", "pool") == "pool"
+        ):
+            # One builder process per build slot
+            builder_pool = BuilderPool(scheduler.max_running)
+        # If None, each build runs in a fresh repo2jupyterlite subprocess
+        self.builder_pool = builder_pool
+        # slug -> Build currently running for it
+        self.in_flight = {}
+        # build id -> Build, for recent builds so their status can be looked up
+        self.builds = Cache(1024)
+
+    def start(self, slug, repo, ref):
+        """
+        Start building repo at ref as slug, or join the in-flight build for slug.
+
+        Returns the Build without waiting for it to complete. Raises
+        BuildQueueFull if a new build would have to be started, and there is
+        no capacity to run it. Callers check if slug is already published
+        first, so that never takes up capacity.
+        """
+        build = self.in_flight.get(slug)
+        if build is None:
+            try:
+                reservation = self.scheduler.reserve()
+            except BuildQueueFull:
+                BUILD_COUNT.labels(status="rejected").inc()
+                raise
+            build = Build(slug, repo, ref)
+            build.task = asyncio.create_task(self._build(build, reservation))
+            self.in_flight[slug] = build
+            self.builds.set(build.id, build)
+            build.task.add_done_callback(lambda t: self._forget(build))
+        return build
+
+    def get_busy_slugs(self):
+        """
+        Return set of slugs being built, and of the builds they are built from
+        """
+        busy_slugs = set()
+        for slug, build in list(self.in_flight.items()):
+            busy_slugs.add(slug)
+            if build.base_slug is not None:
+                busy_slugs.add(build.base_slug)
+        return busy_slugs
+
+    def get_report_path(self, slug):
+        return self.reports_dir / f"{slug}.json"
+
+    def get(self, build_id):
+        """
+        Return the Build with build_id, or None if it is not known
+        """
+        return self.builds.get(build_id)
+
+    def _forget(self, build):
+        if self.in_flight.get(build.slug) is build:
+            del self.in_flight[build.slug]
+        if not build.task.cancelled():
+            # Mark the exception as retrieved - builds started via start()
+            # may never be awaited
+            build.task.exception()
+
+    async def _build(self, build, reservation):
+        try:
+            # A build may have finished between the caller checking for it
+            # and us getting here, in which case we give our reservation back
+            try:
+                exists = await self.publisher.exists(build.slug)
+            except BaseException:
+                self.scheduler.cancel(reservation)
+                raise
+            if exists:
+                self.scheduler.cancel(reservation)
+            else:
+                with span("build", slug=build.slug, repo=build.repo, ref=build.ref):
+                    start_time = time.perf_counter()
+                    async with self.scheduler.slot(reservation):
+                        queue_time = time.perf_counter() - start_time
+                        BUILD_PHASE_TIME.labels(phase="queue").observe(queue_time)
+                        build.set_status("running")
+                        await self._run(build, queue_time)
+        except Exception as e:
+            build.set_status("failed", str(e))
+            BUILD_COUNT.labels(status="failed").inc()
+            raise BuildFailed(str(e)) from e
+        build.set_status("succeeded")
+        BUILD_COUNT.labels(status="succeeded").inc()
+
+    async def _run(self, build, queue_time):
+        report_path = self.get_report_path(build.slug)
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        # Only rebuild what changed since an earlier build of the same repo
+        build.base_slug = await self.publisher.get_base_build(build.slug)
+        base_build = None
+        if build.base_slug is not None:
+            base_build = self.publisher.get_build_dir(build.base_slug)
+        # Fingerprinting inputs is only worth it if later builds can use them
+        record_inputs = self.publisher.supports_base_builds
+        async with self.publisher.get_target_dir(build.slug) as d:
+            if self.builder_pool is not None:
+                await self.builder_pool.run_build(
+                    build, d, report_path, base_build, record_inputs
+                )
+            else:
+                await self._run_subprocess(
+                    build, d, report_path, base_build, record_inputs
+                )
+            with open(report_path) as f:
+                report = json.load(f)
+            for phase in ("fetch", "build"):
+                if phase in report["phases"]:
+                    BUILD_PHASE_TIME.labels(phase=phase).observe(
+                        report["phases"][phase]["wall"]
+                    )
+
+            start_time = time.perf_counter()
+            with span("publish", slug=build.slug):
+                await self.publisher.upload(d, build.slug)
+            publish_time = time.perf_counter() - start_time
+            BUILD_PHASE_TIME.labels(phase="publish").observe(publish_time)
+
+        # Add what happened outside the builder, for a complete picture
+        report["phases"]["queue"] = {"wall": queue_time}
+        report["phases"]["publish"] = {"wall": publish_time}
+        report["counters"].update(slug=build.slug, repo=build.repo, ref=build.ref)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    async def _run_subprocess(
+        self, build, d, report_path, base_build=None, record_inputs=True
+    ):
+        cmd = ["repo2jupyterlite", build.repo]
+        cmd += ["--ref", build.ref]
+        cmd += ["--report-json", str(report_path)]
+        if base_build:
+            cmd += ["--base-build", str(base_build)]
+        if not record_inputs:
+            cmd += ["--no-record-inputs"]
+        cmd += [str(d)]
+
+        log.debug(f"Running {cmd}")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            # Allow for long lines in build output
+            limit=1024 * 1024,
+        )
+        async for line in proc.stdout:
+            line = line.decode("utf-8", "replace").rstrip()
+            build.append_log(line)
+        retcode = await proc.wait()
+        if retcode != 0:
+            raise BuildFailed(f"jupyter lite build failed for {build.slug}")
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import time
+
+log = logging
+
+
+class BuildEvictor:
+    """
+    Keep published builds within a disk budget by evicting least recently used ones.
+
+    Periodically measures how many bytes and inodes the publisher's builds use,
+    and if that is over max_bytes or max_inodes, removes builds in least
+    recently accessed order until it isn't. All filesystem work happens in a
+    thread, so the event loop is never blocked.
+
+    Builds currently being built, builds they are being incrementally built
+    from, and builds accessed in the last grace_period seconds (so likely
+    still being served), are never evicted.
+    """
+
+    def __init__(
+        self,
+        publisher,
+        build_manager,
+        max_bytes=0,
+        max_inodes=0,
+        interval=300,
+        grace_period=600,
+    ):
+        self.publisher = publisher
+        self.build_manager = build_manager
+        # 0 means no limit
+        self.max_bytes = max_bytes
+        self.max_inodes = max_inodes
+        self.interval = interval
+        self.grace_period = grace_period
+        self.evicted_count = 0
+
+    @classmethod
+    def from_environ(cls, publisher, build_manager):
+        return cls(
+            publisher,
+            build_manager,
+            max_bytes=int(os.environ.get("BINDERLITE_OUTPUT_MAX_BYTES", 0)),
+            max_inodes=int(os.environ.get("BINDERLITE_OUTPUT_MAX_INODES", 0)),
+            interval=int(os.environ.get("BINDERLITE_EVICTION_INTERVAL", 300)),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.max_inodes)
+
+    def _over_budget(self, used_bytes, used_inodes):
+        return (self.max_bytes and used_bytes > self.max_bytes) or (
+            self.max_inodes and used_inodes > self.max_inodes
+        )
+
+    def evict(self, busy_slugs):
+        """
+        Evict builds until within budget, never touching slugs in busy_slugs.
+
+        Blocking, so should be run in a thread. Returns list of evicted slugs.
+        """
+        used_bytes, used_inodes = self.publisher.get_usage()
+        if not self._over_budget(used_bytes, used_inodes):
+            return []
+
+        evicted = []
+        now = time.time()
+        for slug, last_access in sorted(
+            self.publisher.list_builds(), key=lambda b: b[1]
+        ):
+            if not self._over_budget(used_bytes, used_inodes):
+                break
+            if slug in busy_slugs or now - last_access < self.grace_period:
+                continue
+            freed_bytes, freed_inodes = self.publisher.get_usage(slug)
+            self.publisher.remove(slug)
+            used_bytes -= freed_bytes
+            used_inodes -= freed_inodes
+            evicted.append(slug)
+
+        if evicted:
+            # Free blobs no longer used by any build
+            self.publisher.store.collect_garbage()
+        self.evicted_count += len(evicted)
+        return evicted
+
+    async def run(self):
+        """
+        Evict builds every interval seconds, forever
+        """
+        while True:
+            await asyncio.sleep(self.interval)
+            busy_slugs = self.build_manager.get_busy_slugs()
+            try:
+                evicted = await asyncio.to_thread(self.evict, busy_slugs)
+            except Exception:
+                log.exception("Evicting builds failed")
+                continue
+            if evicted:
+                log.info(f"Evicted {len(evicted)} builds: {evicted}")
@@ -0,0 +1,55 @@
+"""
+Prometheus metrics and optional OpenTelemetry tracing for binderlite.
+
+Metrics are exposed at /metrics. If opentelemetry-api is installed, spans are
+also recorded for resolving refs, building and serving - configure an
+exporter with the usual OpenTelemetry SDK setup to collect them.
+"""
+
+from contextlib import nullcontext
+
+from prometheus_client import Counter, Histogram
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Builds take anywhere from seconds (everything cached) to tens of minutes
+BUILD_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+BUILD_PHASE_TIME = Histogram(
+    "binderlite_build_phase_duration_seconds",
+    "Time spent in each phase of a build",
+    ["phase"],
+    buckets=BUILD_BUCKETS,
+)
+BUILD_COUNT = Counter(
+    "binderlite_builds_total",
+    "Builds finished, by status",
+    ["status"],
+)
+REQUEST_TIME = Histogram(
+    "binderlite_request_duration_seconds",
+    "Time to respond to requests, up to sending the response headers",
+    ["handler", "code"],
+)
+BYTES_SERVED = Counter(
+    "binderlite_served_bytes_total",
+    "Bytes of response bodies sent, for responses with a known length",
+    ["handler"],
+)
+
+if trace is not None:
+    tracer = trace.get_tracer("binderlite")
+else:
+    tracer = None
+
+
+def span(name, **attributes):
+    """
+    Return context manager recording an OpenTelemetry span, if tracing is available
+    """
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
@@ -0,0 +1,117 @@
+"""
+Packed build archives.
+
+A JupyterLite build is thousands of small files. Packed, a build is a single
+file instead: the contents of every file, followed by a JSON index of
+path -> (offset, length, content type, etag), followed by a fixed size
+trailer pointing to the index. Publishing, evicting or copying a build is
+then a single file operation, and files are served straight out of a
+memory map of the archive.
+"""
+
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import struct
+
+MAGIC = b"R2JLPK01"
+# index offset, index length, magic
+TRAILER = struct.Struct("<QQ8s")
+
+# Files are copied into archives this many bytes at a time
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def pack_tree(source_dir, pack_path):
+    """
+    Pack all files under source_dir into a single archive at pack_path.
+
+    Files with identical contents are only stored once. Precompressed
+    variants (foo.js.gz) are stored as their own entries, with the content
+    type of the file they are a variant of. The archive is written to a
+    temporary file first, and renamed into place once complete.
+    """
+    index = {}
+    # sha256 -> (offset, length) of contents already written
+    blobs = {}
+    tmp_path = f"{pack_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames.sort()
+            for name in sorted(filenames):
+                file_path = os.path.join(dirpath, name)
+                path = os.path.relpath(file_path, source_dir).replace(os.sep, "/")
+                # Copied in chunks, so large files are never all in memory.
+                # We only know if we already have the contents once they
+                # have been copied, so undo the copy if we do.
+                start = f.tell()
+                h = hashlib.sha256()
+                with open(file_path, "rb") as src:
+                    while chunk := src.read(COPY_CHUNK_SIZE):
+                        h.update(chunk)
+                        f.write(chunk)
+                digest = h.hexdigest()
+                if digest in blobs:
+                    f.seek(start)
+                    f.truncate()
+                else:
+                    blobs[digest] = (start, f.tell() - start)
+                offset, length = blobs[digest]
+
+                type_path = path
+                for suffix in (".br", ".gz"):
+                    if path.endswith(suffix):
+                        type_path = path[: -len(suffix)]
+                content_type, _ = mimetypes.guess_type(type_path)
+                index[path] = [
+                    offset,
+                    length,
+                    content_type or "application/octet-stream",
+                    f'"{digest[:32]}"',
+                ]
+
+        index_offset = f.tell()
+        index_data = json.dumps(index, separators=(",", ":")).encode()
+        f.write(index_data)
+        f.write(TRAILER.pack(index_offset, len(index_data), MAGIC))
+    os.rename(tmp_path, pack_path)
+
+
+class PackedBuild:
+    """
+    Read only, memory mapped view of a packed build archive
+    """
+
+    def __init__(self, pack_path):
+        with open(pack_path, "rb") as f:
+            # The mapping stays valid after the file is closed - or even
+            # deleted - so eviction never breaks responses in progress
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, index_length, magic = TRAILER.unpack_from(
+            self.mmap, len(self.mmap) - TRAILER.size
+        )
+        if magic != MAGIC or self.mmap[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{pack_path} is not a packed build")
+        self.index = json.loads(self.mmap[index_offset : index_offset + index_length])
+
+    def lookup(self, path):
+        """
+        Return (path, offset, length, content type, etag) for path, or None.
+
+        Directories resolve to their index.html.
+        """
+        path = path.lstrip("/")
+        for candidate in (path, f"{path.rstrip('/')}/index.html".lstrip("/")):
+            entry = self.index.get(candidate)
+            if entry is not None:
+                return (candidate, *entry)
+        return None
+
+    def read(self, offset, length):
+        """
+        Return a zero copy memoryview of length bytes at offset
+        """
+        return memoryview(self.mmap)[offset : offset + length]
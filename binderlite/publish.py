@@ -1,20 +1,310 @@
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import gzip
+import hashlib
+import mimetypes
+import mmap
 import shutil
 import os
+import stat
 import tempfile
-from contextlib import contextmanager
+import threading
+import time
+import re
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
 from starlette.staticfiles import NotModifiedResponse, StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import (
+    FileResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from email.utils import parsedate
+from repoproviders.utils import Cache
+from repo2jupyterlite.incremental import load_manifest
+from .packed import PackedBuild, pack_tree
 
 output_dir_prefix = Path("output")
 # Create the output dir if it does not exist
 os.makedirs(output_dir_prefix, exist_ok=True)
 
+# Content addressed store of files shared between builds. Must be on the
+# same filesystem as output_dir_prefix, as builds hardlink into it.
+objects_dir = output_dir_prefix / ".objects"
+
+# Builds being deleted are moved here first, so they disappear atomically
+trash_dir = output_dir_prefix / ".trash"
+
+# Builds are written here, and renamed into place once complete. Must be on
+# the same filesystem as output_dir_prefix, so that is atomic.
+staging_dir = output_dir_prefix / ".staging"
+
+# Staging directories not modified for this many seconds were left behind by
+# a server that went away mid build
+STALE_STAGING_AGE = 24 * 60 * 60
+
+# How often, in seconds, we record that a build has been accessed
+ACCESS_TIME_RESOLUTION = 60
+
+# How long, in seconds, we remember that a build exists without checking.
+# Builds can be evicted by other server processes sharing output/.
+EXISTS_MAX_AGE = 60
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files with these extensions are stored precompressed next to the original
+COMPRESSIBLE_EXTENSIONS = {
+    ".css",
+    ".html",
+    ".ipynb",
+    ".js",
+    ".json",
+    ".map",
+    ".md",
+    ".svg",
+    ".txt",
+    ".wasm",
+}
+
+# Compressing smaller files isn't worth the extra request overhead
+MIN_COMPRESS_SIZE = 1024
+
+# Larger files are served as they are, so clients can fetch ranges of them -
+# and compressing them at build time would take longer than it is worth.
+# Only used for builds that don't record the large file size they were built
+# with, as files the build treated as large are never compressed.
+MAX_COMPRESS_SIZE = int(
+    os.environ.get("BINDERLITE_MAX_COMPRESS_SIZE", 10 * 1024 * 1024)
+)
+
+# Files up to this size are kept in memory once served
+HOT_FILE_MAX_SIZE = 256 * 1024
+
+# Builds are addressed by resolved commit hash, so never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Content-Encoding of precompressed variants, and the file suffix they are
+# stored with, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def _precompress_file(path, store=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = None
+    if store is not None:
+        digest = hashlib.sha256(data).hexdigest()
+        if store.link_variants(digest, path):
+            return
+    variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    for suffix, compressed in variants.items():
+        # Only keep variants that are actually smaller
+        if len(compressed) < len(data):
+            with open(f"{path}{suffix}", "wb") as f:
+                f.write(compressed)
+            if digest is not None:
+                store.add_variant(digest, suffix, f"{path}{suffix}")
+
+
+def _get_max_compress_size(root):
+    """
+    Return size of files in the build at root not worth compressing
+    """
+    manifest = load_manifest(root) or {}
+    settings = manifest.get("settings") or {}
+    return settings.get("large_file_size", MAX_COMPRESS_SIZE)
+
+
+def precompress_tree(root, store=None, max_workers=None):
+    """
+    Write .br and .gz variants next to all compressible files under root.
+
+    Compression happens in a pool of threads - zlib and brotli both release
+    the GIL while compressing. gzip output has a fixed mtime, so identical
+    files compress to identical bytes and deduplicate in the object store.
+
+    If store is a ContentAddressedStore, variants are added to it, and files
+    it already has variants of are not compressed again - most files are
+    the same from one build to the next, and brotli at its highest quality
+    is slow.
+
+    Files at least as large as the build's large file size are left as they
+    are, like the build itself does.
+    """
+    max_size = _get_max_compress_size(root)
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if (
+                os.path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS
+                and MIN_COMPRESS_SIZE <= os.path.getsize(path) < max_size
+            ):
+                paths.append(path)
+    with ThreadPoolExecutor(max_workers) as executor:
+        # list() so any failure is raised here
+        list(executor.map(functools.partial(_precompress_file, store=store), paths))
+
+
+def get_accepted_encodings(accept_encoding):
+    """
+    Return tuple of encodings we have variants for that accept_encoding accepts.
+
+    In our order of preference.
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        name, _, value = params.strip().partition("=")
+        if name.strip() == "q":
+            try:
+                if float(value) == 0:
+                    # Explicitly not acceptable
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return tuple(
+        encoding for encoding, _ in ENCODINGS if encoding in accepted or "*" in accepted
+    )
+
+
+def get_precompressed(file_path, accept_encoding):
+    """
+    Return (path, encoding) of the best precompressed variant of file_path.
+
+    Returns (file_path, None) if the client accepts none of the variants
+    we have.
+    """
+    suffixes = dict(ENCODINGS)
+    for encoding in get_accepted_encodings(accept_encoding):
+        variant_path = f"{file_path}{suffixes[encoding]}"
+        if os.path.isfile(variant_path):
+            return variant_path, encoding
+    return file_path, None
+
+
+def etag_matches(etag, request_headers):
+    """
+    Return True if etag is one of the ETags in the request's If-None-Match
+    """
+    if_none_match = request_headers.get("if-none-match", "")
+    return etag in [value.strip() for value in if_none_match.split(",")]
+
+
+def _fault_in(view):
+    """
+    Make sure the pages of memoryview view of a memory map are in memory
+    """
+    # Touches one byte per page, rather than copying all of them
+    view[:: mmap.PAGESIZE].tobytes()
+
+
+def precompressed_file_response(file_path, request_headers, headers=None):
+    """
+    Return a FileResponse for file_path, using a precompressed variant if possible
+    """
+    headers = dict(headers or {})
+    encoding = None
+    if os.path.splitext(file_path)[1] in COMPRESSIBLE_EXTENSIONS:
+        headers["Vary"] = "Accept-Encoding"
+        variant_path, encoding = get_precompressed(
+            file_path, request_headers.get("accept-encoding", "")
+        )
+    if encoding is None:
+        return FileResponse(file_path, headers=headers, stat_result=os.stat(file_path))
+    headers["Content-Encoding"] = encoding
+    media_type, _ = mimetypes.guess_type(str(file_path))
+    # Pass stat_result, so ETag and Last-Modified are set right away, and
+    # can be checked for a Not Modified response
+    return FileResponse(
+        variant_path,
+        headers=headers,
+        media_type=media_type or "application/octet-stream",
+        stat_result=os.stat(variant_path),
+    )
+
+
+class HotFileCache:
+    """
+    LRU cache of small, frequently served files, bounded by total size in bytes.
+
+    Values are (body, headers) tuples, keyed by tuples starting with the
+    slug. Files in published builds only change if the build is replaced or
+    evicted, which is rare enough for invalidate to just scan all entries.
+    Locked, as builds are evicted from a thread.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, headers):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[0])
+            self.entries[key] = (body, headers)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted_body, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted_body)
+
+    def invalidate(self, slug):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == slug]:
+                self.size -= len(self.entries.pop(key)[0])
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves .br or .gz variants of files to clients accepting them
+
+    Paths with a component starting with a dot are not served, as those are
+    where builds are staged, trashed and deduplicated.
+    """
+
+    async def get_response(self, path, scope):
+        if any(part.startswith(".") for part in Path(path).parts):
+            raise HTTPException(status_code=404)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        response = precompressed_file_response(full_path, request_headers)
+        response.status_code = status_code
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
 
 class Publisher:
-    @contextmanager
-    def get_target_dir(self, slug):
+    # Whether get_base_build can ever return a build
+    supports_base_builds = False
+
+    @asynccontextmanager
+    async def get_target_dir(self, slug):
         """
         Return the target directory repo2jupyterlite should put built files into
 
@@ -30,8 +320,8 @@ class Publisher:
         try:
             yield tmpdirname
         finally:
-            # FIXME: Make this async
-            shutil.rmtree(tmpdirname)
+            # Failed builds may not have created the directory at all
+            await asyncio.to_thread(shutil.rmtree, tmpdirname, ignore_errors=True)
 
     async def exists(self, slug):
         """
@@ -39,7 +329,21 @@ class Publisher:
         """
         raise NotImplementedError()
 
-    async def upload(self, slug, source_dir):
+    async def get_base_build(self, slug):
+        """
+        Return slug of a published build an incremental build of slug can start from.
+
+        Returns None if there isn't one.
+        """
+        return None
+
+    def get_build_dir(self, slug):
+        """
+        Return local directory published build slug is in
+        """
+        raise NotImplementedError()
+
+    async def upload(self, source_dir, slug):
         """
         Upload generated files for slug present in source_dir to appropriate target
         """
@@ -53,6 +357,12 @@ class Publisher:
         """
         raise NotImplementedError()
 
+    async def serve_object(self, slug, path, request_headers):
+        """
+        Return a response for path in published slug.
+        """
+        raise NotImplementedError()
+
     def mount_extra_handlers(self, app):
         """
         Mount extra FastAPI handlers in given app if needed.
@@ -60,25 +370,376 @@ class Publisher:
         pass
 
 
+class ContentAddressedStore:
+    """
+    Deduplicate identical files across builds by hardlinking them to shared blobs.
+
+    Most of a JupyterLite build - the application shell, extensions and
+    kernel assets - is byte for byte identical between builds. Each unique
+    file is stored once under store_dir, named by its sha256, and files in
+    builds are hardlinks to it. The filesystem's link count doubles as the
+    reference count: a blob with a link count of 1 is not used by any build,
+    and can be removed by collect_garbage.
+
+    Precompressed variants of blobs are recorded as symlinks from
+    variants/<digest><suffix> to the blob with the compressed contents, and
+    go away with it.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = Path(store_dir)
+
+    def _hash_file(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _blob_path(self, digest):
+        # Shard by prefix, so we don't end up with millions of files in one directory
+        return self.store_dir / digest[:2] / digest[2:]
+
+    def _variant_path(self, digest, suffix):
+        return self.store_dir / "variants" / digest[:2] / f"{digest[2:]}{suffix}"
+
+    def link_variants(self, digest, path):
+        """
+        Link precompressed variants of blob digest next to path.
+
+        Returns False, without linking anything, unless the store has every
+        variant of digest that would be produced.
+        """
+        blobs = {}
+        for encoding, suffix in ENCODINGS:
+            if suffix == ".br" and brotli is None:
+                continue
+            variant_path = self._variant_path(digest, suffix)
+            if not os.path.exists(variant_path):
+                # Variants not smaller than the original aren't kept, so
+                # we can't tell those apart from ones we never made
+                return False
+            blobs[suffix] = variant_path.resolve()
+        try:
+            for suffix, blob_path in blobs.items():
+                os.link(blob_path, f"{path}{suffix}")
+        except FileNotFoundError:
+            # Garbage collected from under us
+            for suffix in blobs:
+                with suppress(FileNotFoundError):
+                    os.unlink(f"{path}{suffix}")
+            return False
+        return True
+
+    def add_variant(self, digest, suffix, path):
+        """
+        Record file at path as the variant with suffix of blob digest
+        """
+        self.add_file(path)
+        blob_path = self._blob_path(self._hash_file(path))
+        variant_path = self._variant_path(digest, suffix)
+        variant_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{variant_path}.{uuid.uuid4().hex}.tmp"
+        os.symlink(os.path.relpath(blob_path, variant_path.parent), tmp_path)
+        os.replace(tmp_path, variant_path)
+
+    def add_file(self, path):
+        """
+        Replace file at path with a hardlink to the blob with its contents.
+
+        Returns True if the blob already existed, False if path was added as
+        a new blob.
+        """
+        blob_path = self._blob_path(self._hash_file(path))
+        while True:
+            try:
+                return self._link_to_blob(path, blob_path)
+            except FileNotFoundError:
+                if not os.path.exists(path):
+                    raise
+                # collect_garbage removed the blob (or its directory) between
+                # us finding it and linking to it, so add it again
+
+    def _link_to_blob(self, path, blob_path):
+        try:
+            blob_stat = blob_path.stat()
+        except FileNotFoundError:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, blob_path)
+                # Blobs are shared between builds, so they must never be
+                # modified in place
+                os.chmod(blob_path, stat.S_IMODE(blob_path.stat().st_mode) & ~0o222)
+                return False
+            except FileExistsError:
+                # Someone else added the same blob just now
+                blob_stat = blob_path.stat()
+
+        if os.stat(path).st_ino != blob_stat.st_ino:
+            # Atomically swap our copy for a link to the blob, so the file
+            # is never missing for anyone serving it
+            tmp_path = f"{path}.cas-tmp"
+            os.link(blob_path, tmp_path)
+            os.replace(tmp_path, path)
+        return True
+
+    def add_tree(self, root):
+        """
+        Deduplicate all regular files under root, returning (new, reused) counts
+        """
+        new = reused = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if not os.path.isfile(path) or os.path.islink(path):
+                    continue
+                if self.add_file(path):
+                    reused += 1
+                else:
+                    new += 1
+        return new, reused
+
+    def collect_garbage(self):
+        """
+        Remove blobs not used by any build, returning the number of bytes freed
+        """
+        freed = 0
+        if not self.store_dir.exists():
+            return freed
+        for dirpath, dirnames, filenames in os.walk(self.store_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    # Variant records, which go once their blob does
+                    if not os.path.exists(path):
+                        os.unlink(path)
+                    continue
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    freed += st.st_size
+            if dirpath != str(self.store_dir) and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return freed
+
+
 class LocalFilesystemPublisher(Publisher):
-    @contextmanager
-    def get_target_dir(self, slug):
-        # Instead of outputing to a temporary directory and then
-        # copying, we have repo2jupyterlite output to the end directory
-        # we are serving files from.
-        output_dir = output_dir_prefix / slug
-        if output_dir.exists():
-            shutil.rmtree(output_dir)
-        yield output_dir
+    """
+    Publish builds to, and serve them from, the output/ directory.
+
+    If packed is True, each build is stored as a single packed archive
+    (see binderlite.packed) at output/<slug>.pack instead of as a directory
+    tree, and served from a memory map of it. Packed builds can not be
+    served by the /render mount.
+    """
+
+    def __init__(self, packed=None):
+        if packed is None:
+            packed = os.environ.get("BINDERLITE_PACKED_BUILDS", "") == "1"
+        self.packed = packed
+        # Packed builds aren't directories we can link files from
+        self.supports_base_builds = not packed
+        # slug -> open PackedBuild. Lock, as packs are opened from threads.
+        self.packs = Cache(1024)
+        self.packs_lock = threading.Lock()
+        # Slugs known to exist, so serving from them doesn't need a stat.
+        # Lock, as builds are removed from threads.
+        self.existing = Cache(100_000, max_age=EXISTS_MAX_AGE)
+        self.existing_lock = threading.Lock()
+        self.store = ContentAddressedStore(objects_dir)
+        # slug -> when we last recorded an access to it. Lock, as builds are
+        # removed from threads.
+        self.last_touched = Cache(100_000)
+        self.last_touched_lock = threading.Lock()
+        # (slug, path, accepted encodings) -> (body, headers)
+        self.hot_files = HotFileCache(
+            int(os.environ.get("BINDERLITE_HOT_FILE_CACHE_BYTES", 64 * 1024 * 1024))
+        )
+        self.reaper = None
+        self.reap_requested = False
+
+    @asynccontextmanager
+    async def get_target_dir(self, slug):
+        # Build into a staging directory on the same filesystem as the
+        # directory we serve files from, so upload can publish it with a
+        # rename instead of copying - and nobody ever sees a half written build.
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        output_dir = staging_dir / uuid.uuid4().hex
+        try:
+            yield output_dir
+        finally:
+            # Still here only if the build failed, or was packed
+            self.discard(output_dir)
+
+    def _move_to_trash(self, path):
+        """
+        Atomically move path into the trash, returning its new path.
+
+        Returns None if path does not exist.
+        """
+        trash_dir.mkdir(exist_ok=True)
+        trash_path = trash_dir / uuid.uuid4().hex
+        try:
+            os.rename(path, trash_path)
+        except FileNotFoundError:
+            return None
+        return trash_path
+
+    def discard(self, path):
+        """
+        Move path out of the way, and delete it in the background.
+
+        Only renames, so is cheap enough to call from the event loop.
+        """
+        if self._move_to_trash(path) is not None:
+            self.empty_trash()
+
+    def empty_trash(self):
+        """
+        Delete everything in the trash in a background thread.
+
+        Must be called from the event loop. At most one reaper runs at a time,
+        and it keeps going until there is nothing left that it was asked about.
+        """
+        self.reap_requested = True
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        while self.reap_requested:
+            self.reap_requested = False
+            await asyncio.to_thread(self._delete_trash)
+
+    def _delete_trash(self):
+        if not trash_dir.exists():
+            return
+        for name in os.listdir(trash_dir):
+            shutil.rmtree(trash_dir / name, ignore_errors=True)
+
+    def start(self):
+        """
+        Clean up after previous runs of the server.
+
+        Stale staging directories and anything left in the trash are deleted
+        in the background.
+        """
+        if staging_dir.exists():
+            for name in os.listdir(staging_dir):
+                path = staging_dir / name
+                try:
+                    if time.time() - path.stat().st_mtime > STALE_STAGING_AGE:
+                        self._move_to_trash(path)
+                except FileNotFoundError:
+                    pass
+        self.empty_trash()
+
+    def _publish(self, source_dir, slug):
+        """
+        Move complete build in source_dir into place as slug.
+
+        rename can't replace a non-empty directory, so an existing build for
+        slug is moved into the trash first. Neither rename yields to the event
+        loop, so no request in this process sees slug missing in between.
+        """
+        target = output_dir_prefix / slug
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(source_dir, target)
+        except OSError:
+            if not target.exists():
+                raise
+            self.discard(target)
+            os.rename(source_dir, target)
+
+    def get_pack_path(self, slug):
+        return output_dir_prefix / f"{slug}.pack"
+
+    def _open_pack(self, slug):
+        with self.packs_lock:
+            pack = self.packs.get(slug)
+            if pack is None:
+                pack = PackedBuild(self.get_pack_path(slug))
+                self.packs.set(slug, pack)
+            return pack
 
     async def upload(self, source_dir, slug):
-        # In get_target_dir
-        # Put our completion sentinel here
-        with open(output_dir_prefix / slug / ".completed-sentinel", "w") as f:
+        if self.packed:
+            await asyncio.to_thread(precompress_tree, source_dir)
+            # pack_tree renames the finished pack into place, and it appearing
+            # is what marks the build as complete. The staging directory is
+            # discarded by get_target_dir.
+            self.get_pack_path(slug).parent.mkdir(parents=True, exist_ok=True)
+            await asyncio.to_thread(pack_tree, source_dir, self.get_pack_path(slug))
+            self._forget(slug)
+            return
+        await asyncio.to_thread(precompress_tree, source_dir, self.store)
+        # Move files shared with other builds into the content addressed
+        # store. This hashes every file, so keep it off the event loop.
+        await asyncio.to_thread(self.store.add_tree, source_dir)
+        # Put our completion sentinel here, so it is published in the same
+        # rename as the rest of the build
+        with open(Path(source_dir) / ".completed-sentinel", "w") as f:
             f.write("")
+        self._publish(source_dir, slug)
+        self._forget(slug)
+
+    def _forget(self, slug):
+        """
+        Drop anything we have in memory about a replaced or removed build of slug
+        """
+        with self.packs_lock:
+            if slug in self.packs:
+                self.packs.pop(slug)
+        with self.existing_lock:
+            if slug in self.existing:
+                self.existing.pop(slug)
+        self.hot_files.invalidate(slug)
+
+    def _exists(self, slug):
+        return (output_dir_prefix / slug / ".completed-sentinel").exists() or (
+            self.get_pack_path(slug).exists()
+        )
 
     async def exists(self, slug):
-        return (output_dir_prefix / slug / ".completed-sentinel").exists()
+        with self.existing_lock:
+            if self.existing.get(slug):
+                return True
+        if not await asyncio.to_thread(self._exists, slug):
+            return False
+        with self.existing_lock:
+            self.existing.set(slug, True)
+        return True
+
+    async def get_base_build(self, slug):
+        if not self.supports_base_builds:
+            return None
+        return await asyncio.to_thread(self._get_base_build, slug)
+
+    def _get_base_build(self, slug):
+        # Slugs end with the resolved ref, so builds of other refs of the
+        # same repo are our siblings. Pick the most recently accessed one, as
+        # that is likely the latest commit on a branch.
+        parent = (output_dir_prefix / slug).parent
+        candidates = []
+        try:
+            with os.scandir(parent) as it:
+                for entry in it:
+                    path = Path(entry.path)
+                    if path.name == Path(slug).name or not entry.is_dir():
+                        continue
+                    try:
+                        mtime = (path / ".completed-sentinel").stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    candidates.append((mtime, path))
+        except FileNotFoundError:
+            return None
+        if not candidates:
+            return None
+        return max(candidates)[1].relative_to(output_dir_prefix).as_posix()
+
+    def get_build_dir(self, slug):
+        return (output_dir_prefix / slug).resolve()
 
     async def get_redirect_url(self, slug):
         return f"/render/{slug}/index.html"
@@ -110,18 +771,386 @@ class LocalFilesystemPublisher(Publisher):
 
         return False
 
-    async def serve_object(self, slug, path, request_headers):
+    async def touch(self, slug):
+        """
+        Record that slug has been accessed, for least recently used eviction.
+
+        The access time is stored as the mtime of the completion sentinel (or
+        pack), so it survives restarts. To keep this cheap, it is only updated once
+        every ACCESS_TIME_RESOLUTION seconds.
+        """
+        now = time.time()
+        with self.last_touched_lock:
+            if now - self.last_touched.get(slug, 0) < ACCESS_TIME_RESOLUTION:
+                return
+            self.last_touched.set(slug, now)
+        await asyncio.to_thread(self._set_access_time, slug)
+
+    def _set_access_time(self, slug):
+        for path in (
+            output_dir_prefix / slug / ".completed-sentinel",
+            self.get_pack_path(slug),
+        ):
+            try:
+                os.utime(path)
+                return
+            except FileNotFoundError:
+                pass
+
+    def list_builds(self):
+        """
+        Return list of (slug, last access time) of all completed builds
+        """
+        builds = []
+        for dirpath, dirnames, filenames in os.walk(output_dir_prefix):
+            for name in filenames:
+                if name.endswith(".pack"):
+                    path = os.path.join(dirpath, name)
+                    slug = os.path.relpath(path, output_dir_prefix)[: -len(".pack")]
+                    builds.append((slug, os.stat(path).st_mtime))
+            if ".completed-sentinel" in filenames:
+                slug = os.path.relpath(dirpath, output_dir_prefix)
+                mtime = os.stat(os.path.join(dirpath, ".completed-sentinel")).st_mtime
+                builds.append((slug, mtime))
+                # Builds don't nest, no need to look inside them
+                dirnames[:] = []
+            else:
+                # Skip the object store and trash
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        return builds
+
+    def get_usage(self, slug=None):
+        """
+        Return (bytes, inodes) used by all builds, or just by slug if given.
+
+        Files hardlinked into the content addressed store are only counted
+        once. For a single slug, only files that would be freed by removing
+        it - those not shared with any other build - are counted.
+        """
+        if slug is not None and self.get_pack_path(slug).exists():
+            return self.get_pack_path(slug).stat().st_size, 1
+        root = output_dir_prefix if slug is None else output_dir_prefix / slug
+        seen = set()
+        used_bytes = used_inodes = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            used_inodes += 1
+            for name in filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                if slug is not None and st.st_nlink > 2:
+                    # Also used by other builds
+                    continue
+                if st.st_ino in seen:
+                    continue
+                seen.add(st.st_ino)
+                used_bytes += st.st_size
+                used_inodes += 1
+        return used_bytes, used_inodes
+
+    def remove(self, slug):
+        """
+        Remove build for slug.
+
+        The build is first moved out of the way atomically, so it is never
+        seen half deleted.
+        """
+        with self.last_touched_lock:
+            if slug in self.last_touched:
+                self.last_touched.pop(slug)
+        try:
+            # Responses in progress keep their memory map of the pack
+            os.unlink(self.get_pack_path(slug))
+        except FileNotFoundError:
+            trash_path = self._move_to_trash(output_dir_prefix / slug)
+            if trash_path is not None:
+                shutil.rmtree(trash_path, ignore_errors=True)
+        # Don't keep serving it from memory
+        self._forget(slug)
+
+    def _get_headers(self, slug, media_type):
+        headers = {}
+        # Slugs end in a resolved commit hash - if they don't, be conservative
+        if re.search(r"/[0-9a-f]{40}$", slug):
+            headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            headers["cache-control"] = "public, max-age=86400"
+
+        headers["content-type"] = media_type or "application/octet-stream"
+        if media_type and media_type.startswith("text/"):
+            headers["content-type"] += "; charset=utf-8"
+        return headers
+
+    def _load_packed_object(self, slug, path, accepted_encodings):
+        pack = self._open_pack(slug)
+        entry = pack.lookup(path)
+        if entry is None:
+            raise FileNotFoundError(path)
+        entry_path, offset, length, content_type, etag = entry
+        headers = self._get_headers(slug, content_type)
+
+        if os.path.splitext(entry_path)[1] in COMPRESSIBLE_EXTENSIONS:
+            headers["vary"] = "Accept-Encoding"
+            suffixes = dict(ENCODINGS)
+            for encoding in accepted_encodings:
+                variant = pack.index.get(f"{entry_path}{suffixes[encoding]}")
+                if variant is not None:
+                    offset, length, _, etag = variant
+                    headers["content-encoding"] = encoding
+                    break
+
+        headers["etag"] = etag
+        if length > HOT_FILE_MAX_SIZE:
+            return (pack, offset, length), headers
+        return bytes(pack.read(offset, length)), headers
+
+    def _load_object(self, slug, path, accepted_encodings):
+        """
+        Find file to serve for path in slug, reading it in if it is small.
+
+        Returns (body, headers) for small files. For larger ones, returns
+        (file_path, headers), or ((pack, offset, length), headers) if the build
+        is packed. Raises FileNotFoundError if there is no such file.
+        Blocking, so should be run in a thread.
+        """
+        if self.get_pack_path(slug).exists():
+            return self._load_packed_object(slug, path, accepted_encodings)
+
         file_path = output_dir_prefix / slug / path
-        print("serving", file_path)
         if file_path.is_dir():
             file_path = file_path / "index.html"
-        # FIXME: Make this configurable, understand Cache-Control better
-        resp = FileResponse(
-            file_path, headers={"Cache-Control": "public, max-age=86400"}
+
+        media_type, _ = mimetypes.guess_type(str(file_path))
+        headers = self._get_headers(slug, media_type)
+
+        serve_path = file_path
+        if file_path.suffix in COMPRESSIBLE_EXTENSIONS:
+            headers["vary"] = "Accept-Encoding"
+            suffixes = dict(ENCODINGS)
+            for encoding in accepted_encodings:
+                variant_path = Path(f"{file_path}{suffixes[encoding]}")
+                if variant_path.is_file():
+                    serve_path = variant_path
+                    headers["content-encoding"] = encoding
+                    break
+
+        st = os.stat(serve_path)
+        if st.st_size > HOT_FILE_MAX_SIZE:
+            return serve_path, headers
+
+        with open(serve_path, "rb") as f:
+            body = f.read()
+        # Strong ETag from the content, so it survives rebuilds and is the
+        # same across all servers
+        headers["etag"] = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        return body, headers
+
+    async def serve_object(self, slug, path, request_headers):
+        await self.touch(slug)
+        accepted_encodings = get_accepted_encodings(
+            request_headers.get("accept-encoding", "")
         )
-        if self.is_not_modified(resp.headers, request_headers):
-            return NotModifiedResponse(resp.headers)
-        return resp
+        key = (slug, path, accepted_encodings)
+        entry = self.hot_files.get(key)
+        if entry is None:
+            try:
+                body_or_path, headers = await asyncio.to_thread(
+                    self._load_object, slug, path, accepted_encodings
+                )
+            except (FileNotFoundError, NotADirectoryError):
+                return Response(status_code=404)
+            if isinstance(body_or_path, tuple):
+                return self._packed_response(body_or_path, headers, request_headers)
+            if isinstance(body_or_path, Path):
+                # Too big to keep in memory, stream it from disk
+                content_type = headers.pop("content-type")
+                resp = FileResponse(
+                    body_or_path,
+                    headers=headers,
+                    media_type=content_type,
+                    stat_result=await asyncio.to_thread(os.stat, body_or_path),
+                )
+                if self.is_not_modified(resp.headers, request_headers):
+                    return NotModifiedResponse(resp.headers)
+                return resp
+            entry = (body_or_path, headers)
+            self.hot_files.set(key, body_or_path, headers)
+
+        body, headers = entry
+        if etag_matches(headers["etag"], request_headers):
+            return NotModifiedResponse(headers)
+        return Response(body, headers=headers)
+
+    def _packed_response(self, location, headers, request_headers):
+        """
+        Stream a large file out of a packed build, supporting single byte ranges
+        """
+        pack, offset, length = location
+        if etag_matches(headers["etag"], request_headers):
+            return NotModifiedResponse(headers)
+
+        headers["accept-ranges"] = "bytes"
+        start, end = 0, length
+        status_code = 200
+        m = re.fullmatch(r"bytes=(\d*)-(\d*)", request_headers.get("range", ""))
+        if m and (m[1] or m[2]):
+            if m[1]:
+                start = int(m[1])
+                end = min(int(m[2]) + 1, length) if m[2] else length
+            else:
+                # Suffix range, the last N bytes
+                start = max(length - int(m[2]), 0)
+            if start >= end:
+                return Response(
+                    status_code=416, headers={"content-range": f"bytes */{length}"}
+                )
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end - 1}/{length}"
+        headers["content-length"] = str(end - start)
+
+        async def chunks(chunk_size=1024 * 1024):
+            for chunk_start in range(start, end, chunk_size):
+                chunk_length = min(chunk_size, end - chunk_start)
+                chunk = pack.read(offset + chunk_start, chunk_length)
+                # Sending straight from the memory map would fault its pages
+                # in from disk on the event loop, so do that in a thread first
+                await asyncio.to_thread(_fault_in, chunk)
+                yield chunk
+
+        return StreamingResponse(chunks(), status_code=status_code, headers=headers)
 
     def mount_extra_handlers(self, app):
-        app.mount("/render", StaticFiles(directory=output_dir_prefix), name="render")
+        app.mount(
+            "/render",
+            PrecompressedStaticFiles(directory=output_dir_prefix),
+            name="render",
+        )
+
+
+class S3Publisher(Publisher):
+    """
+    Publish builds to S3 compatible object storage, and redirect users there.
+
+    Builds are uploaded with up to max_concurrency files in flight at a time,
+    each as a single request or - for large files - one part after another,
+    so there are never more than max_concurrency uploads. A completion
+    sentinel is written only after everything else is uploaded, so checking
+    if a build exists is a single HEAD request. Users are redirected to
+    public_url (the bucket, or a CDN in front of it) so binderlite itself
+    never serves build files.
+
+    Needs boto3. endpoint_url can point to any S3 compatible service, like a
+    local S3 stand-in for testing.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        public_url,
+        prefix="",
+        endpoint_url=None,
+        max_concurrency=16,
+    ):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+        self.prefix = prefix
+        self.max_concurrency = max_concurrency
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            # One connection per upload in flight
+            config=Config(max_pool_connections=max_concurrency),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=16 * 1024 * 1024,
+            multipart_chunksize=16 * 1024 * 1024,
+            # Parallelism comes from uploading many files at once, so parts of a
+            # single large file are uploaded one at a time
+            max_concurrency=1,
+        )
+        # Slugs known to exist. Builds are immutable, so these never go stale.
+        self.existing = Cache(100_000)
+
+    @classmethod
+    def from_environ(cls):
+        return cls(
+            bucket=os.environ["BINDERLITE_S3_BUCKET"],
+            public_url=os.environ["BINDERLITE_S3_PUBLIC_URL"],
+            prefix=os.environ.get("BINDERLITE_S3_PREFIX", ""),
+            endpoint_url=os.environ.get("BINDERLITE_S3_ENDPOINT_URL"),
+            max_concurrency=int(os.environ.get("BINDERLITE_S3_MAX_CONCURRENCY", 16)),
+        )
+
+    def _key(self, slug, path):
+        return f"{self.prefix}{slug}/{path}"
+
+    def _upload_file(self, file_path, key):
+        content_type, encoding = mimetypes.guess_type(file_path)
+        if file_path.suffix == ".wasm":
+            # Needed for WebAssembly.instantiateStreaming
+            content_type = "application/wasm"
+        extra_args = {
+            "ContentType": content_type or "application/octet-stream",
+            # Slugs contain resolved commit hashes, so builds never change
+            "CacheControl": "public, max-age=31536000, immutable",
+        }
+        self.client.upload_file(
+            str(file_path),
+            self.bucket,
+            key,
+            ExtraArgs=extra_args,
+            Config=self.transfer_config,
+        )
+
+    def _upload(self, source_dir, slug):
+        source_dir = Path(source_dir)
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            futures = [
+                executor.submit(
+                    self._upload_file,
+                    file_path,
+                    self._key(slug, file_path.relative_to(source_dir).as_posix()),
+                )
+                for file_path in source_dir.rglob("*")
+                if file_path.is_file()
+            ]
+            for future in futures:
+                # Raise the first failure, if any
+                future.result()
+        # Only mark the build as complete once everything else is there
+        self.client.put_object(
+            Bucket=self.bucket, Key=self._key(slug, ".completed-sentinel"), Body=b""
+        )
+
+    async def upload(self, source_dir, slug):
+        await asyncio.to_thread(self._upload, source_dir, slug)
+        self.existing.set(slug, True)
+
+    def _exists(self, slug):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(
+                Bucket=self.bucket, Key=self._key(slug, ".completed-sentinel")
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    async def exists(self, slug):
+        if self.existing.get(slug):
+            return True
+        exists = await asyncio.to_thread(self._exists, slug)
+        if exists:
+            self.existing.set(slug, True)
+        return exists
+
+    async def get_redirect_url(self, slug):
+        return f"{self.public_url}/{self._key(slug, 'index.html')}"
+
+    async def serve_object(self, slug, path, request_headers):
+        return RedirectResponse(f"{self.public_url}/{self._key(slug, path)}")
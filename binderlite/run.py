@@ -1,7 +1,10 @@
 import asyncio
+import json
 import os
 from pathlib import Path
+import re
 import string
+import time
 from yarl import URL
 
 
@@ -12,10 +15,16 @@ from fastapi.responses import (
     Response,
     HTMLResponse,
     RedirectResponse,
+    StreamingResponse,
 )
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from .publish import LocalFilesystemPublisher
+from starlette.routing import Mount
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from .builds import BuildManager, BuildQueueFull
+from .eviction import BuildEvictor
+from .metrics import BYTES_SERVED, REQUEST_TIME, span
+from .publish import LocalFilesystemPublisher, S3Publisher
 
 HERE = Path(__file__).parent
 
@@ -35,9 +44,65 @@ os.makedirs(output_dir_prefix, exist_ok=True)
 app.mount("/static", StaticFiles(directory=HERE / "static"), name="static")
 
 
-publisher = LocalFilesystemPublisher()
+if os.environ.get("BINDERLITE_PUBLISHER", "local") == "s3":
+    publisher = S3Publisher.from_environ()
+else:
+    publisher = LocalFilesystemPublisher()
 publisher.mount_extra_handlers(app)
 
+build_manager = BuildManager(publisher)
+
+evictor = BuildEvictor.from_environ(publisher, build_manager)
+
+
+@app.on_event("startup")
+async def warm_builder_pool():
+    if build_manager.builder_pool is not None:
+        build_manager.builder_pool.warm()
+
+
+@app.on_event("startup")
+async def start_publisher():
+    if isinstance(publisher, LocalFilesystemPublisher):
+        publisher.start()
+
+
+@app.on_event("startup")
+async def start_evictor():
+    # Only builds on local disk need evicting, object storage has lifecycle rules
+    if evictor.enabled and isinstance(publisher, LocalFilesystemPublisher):
+        # Keep a reference, so the task isn't garbage collected
+        app.state.evictor_task = asyncio.create_task(evictor.run())
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template rather than path, so there are few distinct labels
+    route = request.scope.get("route")
+    handler = getattr(route, "path", "unknown")
+    if route is None:
+        # Mounts don't set the route in our scope
+        for mount in app.routes:
+            if isinstance(mount, Mount) and request.url.path.startswith(
+                mount.path + "/"
+            ):
+                handler = mount.path
+    REQUEST_TIME.labels(handler=handler, code=response.status_code).observe(
+        time.perf_counter() - start_time
+    )
+    if "content-length" in response.headers:
+        BYTES_SERVED.labels(handler=handler).inc(
+            int(response.headers["content-length"])
+        )
+    return response
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -46,8 +111,96 @@ async def index(request: Request):
     )
 
 
+def get_slug(provider_name, resolved_spec):
+    """
+    Return the slug builds of resolved_spec from provider_name are published as
+    """
+    # Explicitly allow "-" and "/", so these output folders nest. Without
+    # this, you will end up with one huge folder with millions of outputs,
+    # which is a perf nightmare
+    return escape(
+        f"{provider_name}-{resolved_spec}",
+        safe=string.ascii_letters + string.digits + "-" + "/",
+    )
+
+
+@app.get("/api/builds/stats")
+async def build_stats():
+    return build_manager.scheduler.get_stats()
+
+
+@app.post("/api/builds/{provider_name:str}/{spec:path}")
+async def start_build(provider_name: str, spec: str):
+    """
+    Start building given spec if needed, without waiting for the build to complete
+    """
+    if provider_name not in repo_providers:
+        raise HTTPException(status_code=404, detail="Unknown provider")
+    provider, _ = repo_providers[provider_name].from_spec_and_path(spec)
+    ref = await provider.get_resolved_ref()
+    if ref is None:
+        raise HTTPException(status_code=404, detail="Could not resolve ref")
+    resolved_spec = await provider.get_resolved_spec()
+    slug = get_slug(provider_name, resolved_spec)
+    url = f"/v1/{provider_name}/{resolved_spec}/lab/index.html"
+
+    if await publisher.exists(slug):
+        return {"slug": slug, "status": "succeeded", "url": url}
+
+    try:
+        build = build_manager.start(slug, provider.get_resolved_repo(), ref)
+    except BuildQueueFull as e:
+        return Response(
+            "Too many builds in progress, please try again later",
+            status_code=503,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return build.to_dict() | {"url": url}
+
+
+@app.get("/api/builds/{build_id}")
+async def build_status(build_id: str):
+    build = build_manager.get(build_id)
+    if build is None:
+        raise HTTPException(status_code=404, detail="Unknown build")
+    return build.to_dict()
+
+
+@app.get("/api/builds/{build_id}/logs")
+async def build_logs(build_id: str):
+    """
+    Stream build logs and status changes as Server-Sent Events
+    """
+    build = build_manager.get(build_id)
+    if build is None:
+        raise HTTPException(status_code=404, detail="Unknown build")
+
+    async def events():
+        async for kind, data in build.follow():
+            if kind == "log":
+                # Carriage returns (progress bars) and newlines end an SSE
+                # field, so each line of the log line gets its own
+                fields = "".join(
+                    f"data: {line}\n" for line in re.split(r"\r\n?|\n", data)
+                )
+                yield f"{fields}\n"
+            else:
+                yield f"event: status\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/v1/{provider_name:str}/{spec_and_path:path}")
 async def render(provider_name: str, spec_and_path: str, request: Request):
+    with span("render", provider=provider_name, spec_and_path=spec_and_path):
+        return await _render(provider_name, spec_and_path, request)
+
+
+async def _render(provider_name: str, spec_and_path: str, request: Request):
     provider_class = repo_providers[provider_name]
 
     provider, path = provider_class.from_spec_and_path(spec_and_path)
@@ -62,7 +215,8 @@ async def render(provider_name: str, spec_and_path: str, request: Request):
         )
         return RedirectResponse(url)
 
-    ref = await provider.get_resolved_ref()
+    with span("resolve", ref=provider.unresolved_ref):
+        ref = await provider.get_resolved_ref()
 
     if ref != provider.unresolved_ref:
         # Ref was resolved! Let's redirect to resolved ref, preserving query params
@@ -75,37 +229,29 @@ async def render(provider_name: str, spec_and_path: str, request: Request):
         return RedirectResponse(url)
 
     resolved_spec = await provider.get_resolved_spec()
-
-    # Explicitly allow "-" and "/", so these output folders nest. Without
-    # this, you will end up with one huge folder with millions of outputs,
-    # which is a perf nightmare
-    slug = escape(
-        f"{provider_name}-{resolved_spec}",
-        safe=string.ascii_letters + string.digits + "-" + "/",
-    )
+    slug = get_slug(provider_name, resolved_spec)
 
     if not (await publisher.exists(slug)):
         # We only trigger builds for files ending with .html, to avoid triggering
         # a ton of builds when we are recovering from partial cache evictions -
         # each JS and CSS thing will trigger its own build!
         if path.endswith(".html"):
-            cmd = ["repo2jupyterlite", provider.get_resolved_repo()]
-            cmd += ["--ref", ref]
-
-            with publisher.get_target_dir(slug) as d:
-                cmd += [str(d)]
-
-                print(cmd)
-                proc = await asyncio.create_subprocess_exec(*cmd)
-                retcode = await proc.wait()
-                if retcode != 0:
-                    raise HTTPException(
-                        status_code=500, detail="jupyter lite build failed"
-                    )
-
-                await publisher.upload(d, slug)
+            # Don't block the request on the build - send a page that follows
+            # the build's progress, and reloads once it is done
+            try:
+                build = build_manager.start(slug, provider.get_resolved_repo(), ref)
+            except BuildQueueFull as e:
+                return Response(
+                    "Too many builds in progress, please try again later",
+                    status_code=503,
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            return templates.TemplateResponse(
+                "building.html",
+                {"request": request, "build": build},
+                status_code=202,
+            )
         else:
             return Response(status_code=404)
-    # FIXME: This means we don't support etags, etc.
-    # But we can and should rely on downstream proxy to support those!
-    return await publisher.serve_object(slug, path, request.headers)
+    with span("serve", slug=slug, path=path):
+        return await publisher.serve_object(slug, path, request.headers)
@@ -1,73 +1,121 @@
 import argparse
+import functools
 import logging
 import os
-import subprocess
 import sys
-from contextlib import nullcontext
+from contextlib import contextmanager, nullcontext
 from tempfile import TemporaryDirectory
 
-from repo2docker import contentproviders
-
-# List of ContentProviders to use
-content_providers = [
-    contentproviders.Local,
-    contentproviders.Zenodo,
-    contentproviders.Figshare,
-    contentproviders.Dataverse,
-    contentproviders.Hydroshare,
-    contentproviders.Swhid,
-    contentproviders.Mercurial,
-    contentproviders.Git,
-]
+from .archive import GitHubArchive, fetch_github_file
+from .contents import ContentsRules
+from .envcache import DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE, EnvironmentCache
+from .gitcache import MirroredGit
+from .incremental import build_incrementally, hash_inputs, write_manifest
+from .providers import registry
+from .report import BuildReport, phase, record
 
 logging.basicConfig(format="%(asctime)s %(msg)s", level=logging.DEBUG)
 log = logging
 
 
-def fetch(url, ref, checkout_path):
+class BuildError(Exception):
+    """
+    Raised when jupyter lite build fails
+    """
+
+
+@contextmanager
+def chdir(path):
+    """
+    Change the working directory to path for the duration of the with block
+    """
+    old_cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
+
+
+def fetch(url, ref, checkout_path, cache_dir=DEFAULT_CACHE_DIR, contents_rules=()):
     """
     Fetch repo from url at ref, and check it out to checkout_path
 
     Uses repo2docker to detect what kinda url is going to be checked out,
     and fetches it into checkout_path.
 
-    checkout_path should be empty.
+    checkout_path should be empty. Content providers that cache what they
+    fetch keep their caches under cache_dir. Content providers that can skip
+    files while fetching leave out what contents_rules exclude.
     """
-    picked_content_provider = None
-    for ContentProvider in content_providers:
-        cp = ContentProvider()
-        spec = cp.detect(url, ref=ref)
-        if spec is not None:
-            picked_content_provider = cp
-            log.info(
-                "Picked {cp} content " "provider.\n".format(cp=cp.__class__.__name__)
-            )
-            break
 
-    if picked_content_provider is None:
-        log.error("No matching content provider found for " "{url}.".format(url=url))
-        # FIXME: How to handle this?
-        return
+    def make_provider(provider_class):
+        if issubclass(provider_class, GitHubArchive):
+            # Rules from the repo's own config aren't known until it is
+            # fetched, but come before these - so what these exclude is
+            # excluded either way
+            rules = ContentsRules(contents_rules) if contents_rules else None
+            return provider_class(cache_dir=cache_dir, contents_rules=rules)
+        if issubclass(provider_class, MirroredGit):
+            return provider_class(cache_dir=cache_dir)
+        return provider_class()
+
+    with phase("detect"):
+        content_provider, spec = registry.detect(url, ref, make_provider)
+    if content_provider is None:
+        raise BuildError(f"No content provider found for {url}")
+    log.info(f"Picked {content_provider.__class__.__name__} content provider.\n")
+    record("content_provider", content_provider.__class__.__name__)
 
-    for log_line in picked_content_provider.fetch(
-        spec, checkout_path, yield_output=True
-    ):
+    for log_line in content_provider.fetch(spec, checkout_path, yield_output=True):
         log.info(log_line, extra=dict(phase="fetching"))
 
 
-def build(repo_dir, output_dir):
+def build(
+    repo_dir,
+    output_dir,
+    env_cache=None,
+    base_build=None,
+    contents_rules=(),
+    large_file_size=None,
+    link_large_files=False,
+    record_inputs=True,
+):
     """
     Build a JupyterLite distribution.
 
     Builds it out of repo_dir, outputs contents to output_dir.
 
     jupyterlite_config.json is read from base of repo if it exists.
+
+    If env_cache is an EnvironmentCache, the xeus-python environment is
+    reused from it when the environment spec has been built before.
+
+    The build runs in this process rather than as a `jupyter lite build`
+    subprocess, so long-lived callers only pay for importing jupyterlite
+    and its addons once.
+
+    If base_build is the output directory of an earlier build of the same
+    repo, only what changed since is rebuilt when possible. See
+    repo2jupyterlite.incremental.
+
+    contents_rules are .gitignore style rules for which files of the repo to
+    include, applied after any in jupyterlite_config.json. Files of at least
+    large_file_size bytes are hardlinked rather than copied into the build
+    if link_large_files is True - only the case for checkouts we fetched,
+    and so never change in place. See repo2jupyterlite.contents.
+
+    Unless record_inputs is False, a fingerprint of every file in the build
+    is kept with it, so it can be the base_build of later builds. Without a
+    base_build, that is the only reason to look at every file.
     """
+    # Imported here, as it is the most expensive import by far
+    from jupyterlite_core.app import LiteBuildApp
+
     abs_output_path = os.path.abspath(output_dir)
+    if base_build is not None:
+        base_build = os.path.abspath(base_build)
     cmd = [
-        "jupyter",
-        "lite",
-        "build",
         ".",
         "--output-dir",
         abs_output_path,
@@ -76,10 +124,114 @@ def build(repo_dir, output_dir):
     ]
     if os.path.exists(os.path.join(repo_dir, "jupyterlite_config.json")):
         cmd += ["--config", "jupyterlite_config.json"]
-    subprocess.check_call(cmd, cwd=repo_dir)
+
+    # Not LiteBuildApp.instance(), as that is a singleton that would be
+    # reused - with its old config - by later builds in the same process
+    app = LiteBuildApp()
+    if env_cache is None:
+        env_cache_enabled = nullcontext()
+    else:
+        env_cache_enabled = env_cache.enabled()
+    rules = ContentsRules.from_repo(repo_dir, contents_rules, large_file_size)
+    inputs = None
+    if base_build is not None or record_inputs:
+        inputs = hash_inputs(repo_dir, rules, local=not link_large_files)
+    # Change what is in the build without changing any inputs
+    settings = {
+        "contents_rules": rules.rules,
+        "large_file_size": rules.large_file_size,
+    }
+    with chdir(repo_dir), env_cache_enabled, rules.enabled(link_large_files):
+        try:
+            app.initialize(cmd)
+            incremental = base_build is not None and build_incrementally(
+                app, repo_dir, abs_output_path, base_build, inputs, settings
+            )
+            record("incremental", incremental)
+            if not incremental:
+                app.start()
+        except SystemExit as e:
+            # LiteBuildApp.start always exits with doit's return code
+            if e.code:
+                raise BuildError(f"jupyter lite build exited with {e.code}")
+    write_manifest(abs_output_path, inputs, settings)
+
+
+@contextmanager
+def _finishing_prebuild(env_cache):
+    """
+    Wait for any environment prebuild started in the with block at its end
+    """
+    try:
+        yield
+    finally:
+        if env_cache is not None:
+            env_cache.finish_prebuild()
+
+
+def fetch_and_build(
+    url,
+    ref,
+    output_dir,
+    env_cache=None,
+    cache_dir=DEFAULT_CACHE_DIR,
+    report=None,
+    base_build=None,
+    contents_rules=(),
+    large_file_size=None,
+    record_inputs=True,
+):
+    """
+    Fetch repo from url at ref if needed, and build it into output_dir
+
+    If report is a BuildReport, the phases of the build and what it
+    produced are recorded in it. base_build, contents_rules,
+    large_file_size and record_inputs are passed on to build.
+    """
+    if report is None:
+        report = BuildReport()
+    with report.active(), _finishing_prebuild(env_cache):
+        if os.path.exists(url):
+            # Trying to build a local path, so no fetching is necessary
+            checkout_dir = url
+            # null context so we have something for `with`
+            temp_dir = nullcontext()
+        else:
+            temp_dir = TemporaryDirectory()
+            checkout_dir = temp_dir.name
+            if env_cache is not None:
+                # Start solving the environment as soon as we have its spec,
+                # rather than once the whole repo has been fetched. The build
+                # waits for it when it gets to the environment.
+                env_cache.start_prebuild(
+                    functools.partial(fetch_github_file, url, ref, "environment.yml"),
+                    report,
+                )
+            with report.phase("fetch"):
+                fetch(url, ref, checkout_dir, cache_dir, contents_rules)
+
+        with temp_dir:
+            with report.phase("build"), report.timing_addons():
+                build(
+                    checkout_dir,
+                    output_dir,
+                    env_cache,
+                    base_build,
+                    contents_rules,
+                    large_file_size,
+                    # Only link files out of checkouts we throw away after
+                    link_large_files=not isinstance(temp_dir, nullcontext),
+                    record_inputs=record_inputs,
+                )
+        report.record_output(output_dir)
 
 
 def main():
+    if sys.argv[1:2] == ["batch"]:
+        from .batch import main as batch_main
+
+        return batch_main(sys.argv[2:])
+
     argparser = argparse.ArgumentParser()
     argparser.add_argument("url", help="URL to repo to build")
     argparser.add_argument(
@@ -89,22 +241,92 @@ def main():
         "--ref", default=None, help="Ref to check out of the repo to build"
     )
 
+    argparser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory to cache built environments and git mirrors in",
+    )
+    argparser.add_argument(
+        "--max-env-cache-size",
+        type=int,
+        default=DEFAULT_MAX_SIZE,
+        help="Maximum size of the environment cache, in bytes",
+    )
+    argparser.add_argument(
+        "--no-env-cache",
+        action="store_true",
+        help="Always build the environment from scratch",
+    )
+    argparser.add_argument(
+        "--exclude",
+        dest="contents_rules",
+        action="append",
+        default=[],
+        help="Leave files matching this .gitignore style pattern out of the build. Can be given multiple times",
+    )
+    argparser.add_argument(
+        "--include",
+        dest="contents_rules",
+        action="append",
+        type=lambda pattern: f"!{pattern}",
+        help="Put files matching this .gitignore style pattern in the build, even if excluded by an earlier pattern. Can be given multiple times",
+    )
+    argparser.add_argument(
+        "--large-file-size",
+        type=int,
+        default=None,
+        help="Size in bytes from which files are linked rather than copied into the build",
+    )
+    argparser.add_argument(
+        "--base-build",
+        default=None,
+        help="Output directory of an earlier build of the same repo, to only rebuild what changed since",
+    )
+    argparser.add_argument(
+        "--no-record-inputs",
+        dest="record_inputs",
+        action="store_false",
+        help="Don't fingerprint the repo's files, so the build can't be used as a --base-build",
+    )
+    argparser.add_argument(
+        "--report-json",
+        default=None,
+        help="Write a JSON report of time and memory used by each phase of the build to this path",
+    )
+    argparser.add_argument(
+        "--profile",
+        default=None,
+        help="Profile the build with cProfile, and dump the stats to this path",
+    )
+
     args = argparser.parse_args()
 
     if os.path.exists(args.output_dir):
         print(f"Output path ${args.output_dir} already exists, aborting...")
         sys.exit(1)
 
-    if os.path.exists(args.url):
-        # Trying to build a local path, so no fetching is necessary
-        checkout_dir = args.url
-        # null context so we have something for `with`
-        temp_dir = nullcontext()
-    else:
-        temp_dir = TemporaryDirectory()
-        checkout_dir = temp_dir.name
-        fetch(args.url, args.ref, checkout_dir)
-
-    with temp_dir:
-        build(checkout_dir, args.output_dir)
-        print(f"Go to http://localhost:8000/{args.output_dir}")
+    report = BuildReport(args.profile)
+    try:
+        env_cache = None
+        if not args.no_env_cache:
+            env_cache = EnvironmentCache(args.cache_dir, args.max_env_cache_size)
+        fetch_and_build(
+            args.url,
+            args.ref,
+            args.output_dir,
+            env_cache,
+            args.cache_dir,
+            report,
+            args.base_build,
+            args.contents_rules,
+            args.large_file_size,
+            args.record_inputs,
+        )
+    except BuildError as e:
+        print(e)
+        report.counters["error"] = str(e)
+        sys.exit(1)
+    finally:
+        if args.report_json:
+            report.write(args.report_json)
+    print(f"Go to http://localhost:8000/{args.output_dir}")
@@ -0,0 +1,262 @@
+"""
+Content provider fetching GitHub repos as archives instead of git clones.
+
+Building a JupyterLite distribution never needs git history, so when the
+ref to build is an exact commit hash we can download GitHub's tarball of
+that commit and extract it as it streams in - skipping the history
+download entirely.
+
+Files excluded by contents rules (see repo2jupyterlite.contents) are
+skipped as the archive streams by, so they never reach the disk.
+
+fetch_github_file fetches a single file of a GitHub repo, for when we need
+to know what is in it before the rest of the repo has been fetched.
+"""
+
+import os
+import re
+import shutil
+import tarfile
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import PurePosixPath
+
+from repo2docker.contentproviders.base import ContentProviderException
+
+from .gitcache import MirroredGit
+from .incremental import CONFIG_DIRS, CONFIG_FILES
+from .report import count, record
+
+# Seconds without any data from GitHub after which we give up on an archive
+ARCHIVE_TIMEOUT = 60
+
+# tarfile's extraction filters are only in Python 3.10.12+ and 3.11.4+
+HAS_TAR_FILTERS = hasattr(tarfile, "data_filter")
+_FilterError = getattr(tarfile, "FilterError", ())
+
+
+def _is_safe_member(member):
+    """
+    Return True if extracting member can't write outside of where it is extracted.
+
+    Only used on Pythons without tarfile extraction filters, as the "data"
+    filter checks this - and more - for us.
+    """
+    path = PurePosixPath(member.name)
+    if path.is_absolute() or ".." in path.parts:
+        return False
+    if member.issym() or member.islnk():
+        link = PurePosixPath(member.linkname)
+        if member.issym():
+            # Relative to the directory the symlink is in
+            link = PurePosixPath(os.path.normpath(path.parent / link))
+        return not (link.is_absolute() or ".." in link.parts)
+    return member.isreg() or member.isdir()
+
+
+def _parse_api_base_paths(value):
+    """
+    Parse 'hostname=api_base_path,...' into a dict
+    """
+    api_base_paths = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            hostname, api_base_path = pair.split("=", 1)
+            api_base_paths[hostname.strip()] = api_base_path.strip().rstrip("/")
+    return api_base_paths
+
+
+# GitHub hostnames we fetch archives from, and the base URL of their API.
+# Add GitHub Enterprise hosts with REPO2JUPYTERLITE_GITHUB_API_BASE_PATHS, e.g.
+# 'github.example.com=https://github.example.com/api/v3'
+DEFAULT_API_BASE_PATHS = {
+    "github.com": "https://api.github.com",
+    **_parse_api_base_paths(
+        os.environ.get("REPO2JUPYTERLITE_GITHUB_API_BASE_PATHS", "")
+    ),
+}
+
+
+def _parse_github_url(source, api_base_paths):
+    """
+    Return (api_base_path, user, repo) of a GitHub repo URL, or None if it isn't one
+    """
+    m = re.fullmatch(
+        r"https://(?P<hostname>[^/]+)/(?P<user>[^/]+)/(?P<repo>[^/]+?)(\.git)?/?",
+        source,
+    )
+    if m is None or m["hostname"] not in api_base_paths:
+        return None
+    return api_base_paths[m["hostname"]], m["user"], m["repo"]
+
+
+def _get_auth_headers():
+    access_token = os.environ.get("GITHUB_ACCESS_TOKEN")
+    if access_token:
+        return {"Authorization": f"token {access_token}"}
+    return {}
+
+
+def fetch_github_file(source, ref, path, api_base_paths=None):
+    """
+    Return contents of path in GitHub repo at source, at ref.
+
+    Fetches just that one file, without the rest of the repo. Returns None if
+    source is not a GitHub repo, or has no such file.
+    """
+    if api_base_paths is None:
+        api_base_paths = DEFAULT_API_BASE_PATHS
+    parsed = _parse_github_url(source, api_base_paths)
+    if parsed is None:
+        return None
+    api_base_path, user, repo = parsed
+    url = f"{api_base_path}/repos/{user}/{repo}/contents/{urllib.parse.quote(path)}"
+    if ref:
+        url += "?" + urllib.parse.urlencode({"ref": ref})
+    headers = _get_auth_headers()
+    headers["Accept"] = "application/vnd.github.raw"
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        # Short timeout, as builds may be waiting to know what this is
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            data = resp.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+    count("fetched_bytes", len(data))
+    return data
+
+
+class _CountingReader:
+    """
+    File-like wrapper counting bytes read through it as fetched_bytes
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        count("fetched_bytes", len(data))
+        return data
+
+
+class GitHubArchive(MirroredGit):
+    """
+    Provide contents of a GitHub repo at a commit by streaming its tarball.
+
+    Only used when ref is a full commit hash, as only then is the archive
+    guaranteed to be the same as a clone. Archives don't contain submodules,
+    so repos that have them are fetched with git instead.
+
+    Members that would be extracted outside of the output directory (like
+    absolute symlinks) are skipped. If contents_rules is a ContentsRules,
+    files it excludes are skipped too - except for the files in the root of
+    the repo that configure the build.
+    """
+
+    def __init__(self, *args, api_base_paths=None, contents_rules=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if api_base_paths is None:
+            api_base_paths = DEFAULT_API_BASE_PATHS
+        self.api_base_paths = api_base_paths
+        self.contents_rules = contents_rules
+
+    def _should_extract(self, path, is_dir):
+        if self.contents_rules is None:
+            return True
+        # Needed to build the repo, whether or not they are contents
+        if path in CONFIG_FILES or path == ".gitmodules":
+            return True
+        if path.split("/", 1)[0] in CONFIG_DIRS:
+            return True
+        return not self.contents_rules.excludes(path, is_dir)
+
+    def detect(self, source, ref=None, extra_args=None):
+        if not ref or not re.fullmatch(r"[0-9a-f]{40}", ref):
+            return None
+        parsed = _parse_github_url(source, self.api_base_paths)
+        if parsed is None:
+            return None
+        api_base_path, user, repo = parsed
+        return {
+            "repo": source,
+            "ref": ref,
+            "archive_url": f"{api_base_path}/repos/{user}/{repo}/tarball/{ref}",
+        }
+
+    def fetch(self, spec, output_dir, yield_output=False):
+        req = urllib.request.Request(spec["archive_url"], headers=_get_auth_headers())
+
+        yield f"Fetching archive of {spec['repo']} at {spec['ref']}\n"
+        extracted = 0
+        skipped = []
+        # path -> size of members left out by contents rules
+        excluded = {}
+        try:
+            # GitHub redirects to codeload, which urllib follows for us
+            with urllib.request.urlopen(req, timeout=ARCHIVE_TIMEOUT) as resp:
+                # 'r|gz' reads the archive as a stream, never holding
+                # all of it in memory or on disk
+                with tarfile.open(fileobj=_CountingReader(resp), mode="r|gz") as tar:
+                    for member in tar:
+                        # Archives have everything under a single
+                        # '<user>-<repo>-<sha>/' directory
+                        parts = PurePosixPath(member.name).parts[1:]
+                        if not parts:
+                            continue
+                        path = str(PurePosixPath(*parts))
+                        member.name = path
+                        if member.islnk():
+                            # Hardlinks point to other members by name
+                            link_parts = PurePosixPath(member.linkname).parts[1:]
+                            member.linkname = str(PurePosixPath(*link_parts))
+                        if not self._should_extract(path, member.isdir()) or (
+                            # Can't link to what we didn't extract
+                            member.islnk()
+                            and member.linkname in excluded
+                        ):
+                            if not member.isdir():
+                                excluded[path] = member.size
+                            continue
+                        try:
+                            if HAS_TAR_FILTERS:
+                                tar.extract(member, output_dir, filter="data")
+                            elif _is_safe_member(member):
+                                tar.extract(member, output_dir)
+                            else:
+                                skipped.append(path)
+                                continue
+                        except _FilterError:
+                            skipped.append(path)
+                            continue
+                        if not member.isdir():
+                            extracted += 1
+        except (OSError, tarfile.TarError) as e:
+            raise ContentProviderException(
+                f"Failed to fetch archive of {spec['repo']} at {spec['ref']}: {e}"
+            ) from e
+        yield f"Extracted {extracted} files from archive\n"
+        if excluded:
+            yield f"Left out {len(excluded)} files excluded by contents rules\n"
+            record(
+                "fetch_excluded",
+                {"count": len(excluded), "bytes": sum(excluded.values())},
+            )
+        for path in skipped:
+            yield f"Skipped {path}, which points outside of the repo\n"
+
+        if os.path.exists(os.path.join(output_dir, ".gitmodules")):
+            yield "Repo has submodules, which archives don't include. Using git.\n"
+            for name in os.listdir(output_dir):
+                path = os.path.join(output_dir, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            yield from super().fetch(spec, output_dir, yield_output)
+            return
+
+        self._sha1 = spec["ref"]
@@ -0,0 +1,166 @@
+"""
+Build many repos in parallel, as listed in a manifest.
+
+`repo2jupyterlite batch manifest.jsonl` builds every entry of the manifest on
+a pool of builder processes (see repo2jupyterlite.worker), one per CPU by
+default. All builds share the same git mirrors and environment cache.
+
+The manifest is either JSON lines or (if it ends with .yml or .yaml) a YAML
+list, of entries like:
+
+    {"url": "https://github.com/org/repo", "ref": "main", "output": "builds/repo"}
+
+`ref` is optional. Each build is written to `<output>.partial`, and only
+renamed to `<output>` once it is complete - so an interrupted run can just
+be started again, and skips everything it already built.
+
+One JSON line is printed per entry as it finishes, with its status
+(succeeded, failed or skipped) and the build's report.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import worker
+from .envcache import DEFAULT_CACHE_DIR
+from .incremental import MANIFEST_NAME
+
+log = logging
+
+
+def load_entries(manifest_path):
+    """
+    Return list of entries in the manifest at manifest_path
+    """
+    with open(manifest_path) as f:
+        if manifest_path.endswith((".yml", ".yaml")):
+            import yaml
+
+            entries = yaml.safe_load(f) or []
+        else:
+            entries = [json.loads(line) for line in f if line.strip()]
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or "url" not in entry or "output" not in entry:
+            raise ValueError(f"Entry {i} of {manifest_path} needs a url and output")
+    return entries
+
+
+def is_complete(output_dir):
+    """
+    Return True if output_dir has a complete build in it
+    """
+    return os.path.exists(os.path.join(output_dir, MANIFEST_NAME))
+
+
+def run_entry(entry, cache_dir):
+    """
+    Build entry in a builder process, returning a dict describing how it went.
+
+    Builds into a .partial directory next to the output, and renames it
+    into place only once the build succeeded.
+    """
+    output_dir = os.path.abspath(entry["output"])
+    partial_dir = f"{output_dir}.partial"
+    # Left behind by an interrupted run
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+    result = {"log": f"{output_dir}.log"}
+    start_time = time.perf_counter()
+    with tempfile.NamedTemporaryFile(suffix=".json") as report_file:
+        try:
+            worker.run_build(
+                entry["url"],
+                entry.get("ref"),
+                partial_dir,
+                result["log"],
+                report_file.name,
+                cache_dir=cache_dir,
+            )
+            os.rename(partial_dir, output_dir)
+            result["status"] = "succeeded"
+        except Exception as e:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            result["status"] = "failed"
+            result["error"] = str(e)
+        result["duration"] = time.perf_counter() - start_time
+        try:
+            with open(report_file.name) as f:
+                result["report"] = json.load(f)
+        except json.JSONDecodeError:
+            # Failed before the report could be written
+            pass
+    return result
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(
+        prog="repo2jupyterlite batch",
+        description="Build all repos listed in a manifest, in parallel",
+    )
+    argparser.add_argument(
+        "manifest", help="JSON lines or YAML file of url, ref and output entries"
+    )
+    argparser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of builds to run at the same time, one per CPU by default",
+    )
+    argparser.add_argument(
+        "--cache-dir",
+        default=DEFAULT_CACHE_DIR,
+        help="Directory to cache built environments and git mirrors in",
+    )
+    args = argparser.parse_args(argv)
+
+    entries = load_entries(args.manifest)
+    failed = 0
+    futures = {}
+    with ProcessPoolExecutor(
+        max_workers=args.jobs,
+        # Builds chdir and redirect output, so don't share anything with us
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=worker.initialize,
+    ) as executor:
+        for entry in entries:
+            result = {
+                "url": entry["url"],
+                "ref": entry.get("ref"),
+                "output": entry["output"],
+            }
+            if is_complete(entry["output"]):
+                print(json.dumps(result | {"status": "skipped"}), flush=True)
+            elif os.path.exists(entry["output"]):
+                # Not ours to remove
+                failed += 1
+                error = "Output path already exists, but is not a complete build"
+                print(
+                    json.dumps(result | {"status": "failed", "error": error}),
+                    flush=True,
+                )
+            else:
+                future = executor.submit(run_entry, entry, args.cache_dir)
+                futures[future] = result
+
+        for future in as_completed(futures):
+            result = futures[future]
+            try:
+                result |= future.result()
+            except Exception as e:
+                # The builder process itself died
+                result |= {"status": "failed", "error": str(e)}
+            if result["status"] == "failed":
+                failed += 1
+            print(json.dumps(result), flush=True)
+
+    if failed:
+        log.error(f"{failed} of {len(entries)} builds failed")
+        sys.exit(1)
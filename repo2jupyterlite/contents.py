@@ -0,0 +1,223 @@
+"""
+Choose which files of a repo go into its JupyterLite build, and how.
+
+By default every file in the repo (other than what jupyterlite itself
+ignores, like .git) is copied into the build and indexed. ContentsRules
+narrows that down with .gitignore style rules, from the `--exclude` and
+`--include` flags and the repo's jupyterlite_config.json:
+
+    {
+      "Repo2JupyterLite": {
+        "contents_rules": ["data/", "!data/sample.csv", "*.mp4"],
+        "large_file_size": 10485760
+      }
+    }
+
+As in a .gitignore, later rules win, `!` re-includes what an earlier rule
+excluded, and nothing inside an excluded directory can be re-included.
+
+JupyterLite only fetches a file's contents when it is opened - its contents
+listings only hold names, sizes and dates - so large files don't slow down
+loading a build, and there is nothing to gain from serving them any
+differently. Copying them does slow down building it though. Files of at least large_file_size bytes are hardlinked into the build
+instead of copied when the checkout is ours to give away, and are never
+precompressed by binderlite, so they are served as is with HTTP range
+support.
+"""
+
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+from .envcache import _link_or_copy, _tree_size
+from .report import record
+
+log = logging
+
+DEFAULT_LARGE_FILE_SIZE = int(
+    os.environ.get("REPO2JUPYTERLITE_LARGE_FILE_SIZE", 10 * 1024 * 1024)
+)
+
+# At most this many excluded paths are listed in build reports
+MAX_REPORTED_PATHS = 100
+
+
+def _translate(pattern):
+    """
+    Return regex matching the same relative paths as .gitignore pattern
+    """
+    parts = re.split(r"(\*\*/|/\*\*$|\*\*|\*|\?|\[[^\]]*\])", pattern)
+    regex = ""
+    for part in parts:
+        if part == "**/":
+            regex += "(?:.*/)?"
+        elif part == "/**":
+            regex += "/.*"
+        elif part == "**":
+            regex += ".*"
+        elif part == "*":
+            regex += "[^/]*"
+        elif part == "?":
+            regex += "[^/]"
+        elif part.startswith("[") and part.endswith("]") and len(part) > 2:
+            regex += "[^" + part[2:] if part[1] == "!" else part
+        else:
+            regex += re.escape(part)
+    return regex
+
+
+def compile_rule(rule):
+    """
+    Return (regex, negated, directories_only) for .gitignore style rule.
+
+    Returns None for blank lines and comments.
+    """
+    rule = rule.strip()
+    if not rule or rule.startswith("#"):
+        return None
+    negated = rule.startswith("!")
+    if negated:
+        rule = rule[1:]
+    directories_only = rule.endswith("/")
+    rule = rule.rstrip("/")
+    if "/" in rule:
+        # Anchored to the root of the repo
+        regex = "^" + _translate(rule.lstrip("/")) + "$"
+    else:
+        regex = "^(?:.*/)?" + _translate(rule) + "$"
+    return re.compile(regex), negated, directories_only
+
+
+class ContentsRules:
+    """
+    .gitignore style rules for which files of a repo go into its build.
+
+    See the module docstring for what rules look like.
+    """
+
+    def __init__(self, rules=(), large_file_size=DEFAULT_LARGE_FILE_SIZE):
+        self.rules = list(rules)
+        self.large_file_size = large_file_size
+        self.compiled = [c for c in map(compile_rule, self.rules) if c is not None]
+        # relative path (ending with / for directories) -> size in bytes
+        self.excluded = {}
+        # source path -> size in bytes
+        self.large_files = {}
+
+    @classmethod
+    def from_repo(cls, repo_dir, rules=(), large_file_size=None):
+        """
+        Return rules from jupyterlite_config.json in repo_dir, followed by rules.
+
+        large_file_size, if given, overrides the one from the config.
+        """
+        config = {}
+        config_path = Path(repo_dir) / "jupyterlite_config.json"
+        if config_path.exists():
+            try:
+                with open(config_path) as f:
+                    config = json.load(f).get("Repo2JupyterLite", {})
+            except (json.JSONDecodeError, AttributeError) as e:
+                log.warning(f"Could not read contents rules from {config_path}: {e}")
+        if large_file_size is None:
+            large_file_size = config.get("large_file_size", DEFAULT_LARGE_FILE_SIZE)
+        return cls(
+            [*config.get("contents_rules", []), *rules],
+            large_file_size,
+        )
+
+    def is_excluded(self, rel_path, is_dir=False):
+        """
+        Return True if rel_path (relative to the root of the repo) is excluded
+        """
+        excluded = False
+        for regex, negated, directories_only in self.compiled:
+            if directories_only and not is_dir:
+                continue
+            if regex.match(rel_path):
+                excluded = not negated
+        return excluded
+
+    def excludes(self, rel_path, is_dir=False):
+        """
+        Return True if rel_path is excluded, or is in a directory that is
+        """
+        parts = rel_path.split("/")
+        for i in range(1, len(parts)):
+            if self.is_excluded("/".join(parts[:i]), is_dir=True):
+                return True
+        return self.is_excluded(rel_path, is_dir)
+
+    @contextmanager
+    def enabled(self, link_large_files=False):
+        """
+        Apply these rules to the contents of builds in the with block.
+
+        If link_large_files is True, large files are hardlinked into builds
+        rather than copied - only safe if nothing will modify the originals.
+        What was excluded and how many large files there were is recorded in
+        the active report.
+        """
+        from jupyterlite_core.addons.contents import ContentsAddon
+
+        original_maybe_add_one_path = ContentsAddon.maybe_add_one_path
+        original_copy_one = ContentsAddon.copy_one
+
+        def maybe_add_one_path(addon, path, root=None):
+            if root is not None:
+                rel_path = path.relative_to(root).as_posix()
+                is_dir = path.is_dir()
+                if self.is_excluded(rel_path, is_dir):
+                    if is_dir:
+                        self.excluded[f"{rel_path}/"] = _tree_size(path)
+                    else:
+                        self.excluded[rel_path] = path.stat().st_size
+                    return
+            yield from original_maybe_add_one_path(addon, path, root)
+
+        def copy_one(addon, src, dest):
+            src = Path(src)
+            if src.is_file() and src.stat().st_size >= self.large_file_size:
+                self.large_files[str(src)] = src.stat().st_size
+                if link_large_files:
+                    dest = Path(dest)
+                    if dest.exists():
+                        dest.unlink()
+                    dest.parent.mkdir(parents=True, exist_ok=True)
+                    _link_or_copy(src, dest)
+                    return
+            return original_copy_one(addon, src, dest)
+
+        ContentsAddon.maybe_add_one_path = maybe_add_one_path
+        ContentsAddon.copy_one = copy_one
+        try:
+            yield
+        finally:
+            ContentsAddon.maybe_add_one_path = original_maybe_add_one_path
+            ContentsAddon.copy_one = original_copy_one
+            self.record()
+
+    def record(self):
+        """
+        Record what was excluded, and large files, in the active report
+        """
+        if self.excluded:
+            record(
+                "contents_excluded",
+                {
+                    "paths": sorted(self.excluded)[:MAX_REPORTED_PATHS],
+                    "count": len(self.excluded),
+                    "bytes": sum(self.excluded.values()),
+                },
+            )
+        if self.large_files:
+            record(
+                "contents_large_files",
+                {
+                    "count": len(self.large_files),
+                    "bytes": sum(self.large_files.values()),
+                },
+            )
@@ -0,0 +1,406 @@
+"""
+Cache of built xeus-python environments.
+
+Solving and packing the emscripten environment described by a repo's
+environment.yml is the slowest part of most builds, and is redone for every
+commit even when environment.yml has not changed. EnvironmentCache keys built
+environments by a hash of everything that goes into them, and reuses them
+across builds.
+
+It can also start building an environment before the repo has been fetched
+(see EnvironmentCache.start_prebuild), so the two overlap.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+from .report import record
+
+log = logging
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "REPO2JUPYTERLITE_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "repo2jupyterlite",
+    ),
+)
+
+DEFAULT_MAX_SIZE = int(
+    os.environ.get("REPO2JUPYTERLITE_ENV_CACHE_MAX_SIZE", 20 * 1024 * 1024 * 1024)
+)
+
+# Platform the environments are built for
+PLATFORM = "emscripten-wasm32"
+
+# Entries being put in the cache that are older than this (in seconds) were
+# left behind by a build that was killed
+STALE_TMP_AGE = 60 * 60
+
+
+def _link_or_copy(src, dst):
+    """
+    Hardlink src to dst if possible, copying it otherwise
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+class EnvironmentCache:
+    """
+    Size bounded LRU cache of packed xeus-python environments.
+
+    Each entry is a directory named by the environment's hash, containing
+    `packed/` (what jupyterlite-xeus-python copies into the build) and
+    `prefix/` (the parts of the environment prefix the build reads from).
+    The mtime of an entry is bumped whenever it is used, and least recently
+    used entries are evicted once the cache is over max_size bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        # Absolute, as builds change the working directory while prebuilds
+        # use the cache
+        cache_dir = Path(cache_dir).absolute()
+        self.cache_dir = cache_dir / "envs"
+        self.max_size = max_size
+        # Arguments other than the environment file the last environment
+        # was built with, which prebuilds reuse
+        self.build_args_path = Path(cache_dir) / "env-build-args.json"
+        # (future of key, future of being done, thread) of the prebuild in
+        # progress
+        self.prebuilding = None
+
+    def get_key(self, environment_file, **build_kwargs):
+        """
+        Return a hash of the environment spec, or None if it can not be cached.
+
+        build_kwargs are the other arguments the environment is built with,
+        like packages and xeus_python_version.
+        """
+        import yaml
+
+        env_data = None
+        if environment_file and Path(environment_file).exists():
+            with open(environment_file) as f:
+                env_data = yaml.safe_load(f)
+            for dependency in (env_data or {}).get("dependencies") or []:
+                if isinstance(dependency, dict) and dependency.get("pip"):
+                    for pip_dep in dependency["pip"]:
+                        if os.path.isdir(Path(environment_file).parent / pip_dep):
+                            # Local packages may change without environment.yml
+                            # changing, so we can't key on it alone
+                            return None
+
+        try:
+            xeus_python_addon_version = version("jupyterlite-xeus-python")
+        except PackageNotFoundError:
+            xeus_python_addon_version = None
+
+        spec = {
+            # Normalized, so formatting and comment changes don't matter
+            "environment": env_data,
+            "build": {
+                k: v
+                for k, v in build_kwargs.items()
+                # Differs between builds without affecting the environment
+                if k not in ("output_path", "log")
+            },
+            "platform": PLATFORM,
+            "jupyterlite-xeus-python": xeus_python_addon_version,
+        }
+        return hashlib.sha256(
+            json.dumps(spec, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        """
+        Return path to cache entry for key, or None if there is none
+        """
+        entry = self.cache_dir / key
+        if not entry.exists():
+            return None
+        # Mark as recently used
+        os.utime(entry)
+        return entry
+
+    def put(self, key, packed_dir, env_prefix):
+        """
+        Add packed environment in packed_dir built from env_prefix to the cache.
+
+        Returns path to the new cache entry.
+        """
+        from jupyterlite_core.constants import SHARE_LABEXTENSIONS
+
+        entry = self.cache_dir / key
+        tmp_entry = self.cache_dir / f".{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        shutil.copytree(packed_dir, tmp_entry / "packed")
+        labextensions = Path(env_prefix) / SHARE_LABEXTENSIONS
+        if labextensions.exists():
+            shutil.copytree(labextensions, tmp_entry / "prefix" / SHARE_LABEXTENSIONS)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # Another build put the same environment in the cache first
+            shutil.rmtree(tmp_entry)
+        self.evict()
+        return entry
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_size.
+
+        Also removes entries that were left half put in the cache.
+        """
+        entries = []
+        now = time.time()
+        for entry in self.cache_dir.iterdir():
+            try:
+                mtime = entry.stat().st_mtime
+                if entry.name.startswith("."):
+                    if now - mtime > STALE_TMP_AGE:
+                        log.info(f"Removing stale environment {entry.name}")
+                        shutil.rmtree(entry, ignore_errors=True)
+                    # Otherwise still being put in the cache
+                    continue
+                entries.append((mtime, _tree_size(entry), entry))
+            except FileNotFoundError:
+                # Evicted by another build at the same time
+                continue
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            log.info(f"Evicting environment {entry.name} from cache")
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+    def _save_build_args(self, kwargs):
+        build_args = {
+            k: v
+            for k, v in kwargs.items()
+            if k not in ("environment_file", "output_path")
+        }
+        if "log" in build_args:
+            # Not serializable, prebuilds pass their own
+            build_args["log"] = None
+        if any(
+            isinstance(v, (str, Path)) and not os.path.isabs(v) and os.path.exists(v)
+            for v in build_args.values()
+        ):
+            # Relative to the repo (like an empack config in it), which
+            # prebuilds run before exists
+            self.build_args_path.unlink(missing_ok=True)
+            return
+        tmp_path = f"{self.build_args_path}.{os.getpid()}.tmp"
+        self.build_args_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, "w") as f:
+            json.dump(build_args, f, default=str)
+        os.replace(tmp_path, self.build_args_path)
+
+    def _prebuild(self, fetch_spec, key_future, report, abandoned):
+        import yaml
+        from jupyterlite_xeus_python import env_build_addon
+
+        spec = fetch_spec()
+        try:
+            with open(self.build_args_path) as f:
+                build_args = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Never built an environment, so we don't know how to
+            build_args = None
+        if spec is None or build_args is None:
+            key_future.set_result(None)
+            return
+        for dependency in (yaml.safe_load(spec) or {}).get("dependencies") or []:
+            if isinstance(dependency, dict) and any(
+                pip_dep.startswith((".", "/"))
+                for pip_dep in dependency.get("pip") or []
+            ):
+                # Local packages, which aren't there until the repo is
+                key_future.set_result(None)
+                return
+        if "log" in build_args:
+            build_args["log"] = logging.getLogger(__name__)
+
+        with tempfile.TemporaryDirectory() as d:
+            environment_file = Path(d) / "environment.yml"
+            environment_file.write_bytes(spec)
+            key = self.get_key(environment_file, **build_args)
+            key_future.set_result(key)
+            if key is None or abandoned.is_set() or self.get(key) is not None:
+                return
+            log.info(f"Building environment {key} alongside fetching the repo")
+            start_time = time.perf_counter()
+            output_path = Path(d) / "packed"
+            # Unwrapped, in case the cache is enabled() while we build
+            build_and_pack_emscripten_env = getattr(
+                env_build_addon.build_and_pack_emscripten_env,
+                "__wrapped__",
+                env_build_addon.build_and_pack_emscripten_env,
+            )
+            env_prefix = build_and_pack_emscripten_env(
+                environment_file=str(environment_file),
+                output_path=output_path,
+                **build_args,
+            )
+            if env_prefix:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self.put(key, output_path, env_prefix)
+            # An abandoned prebuild may finish after the report is written
+            if report is not None and not abandoned.is_set():
+                report.counters["environment_prebuild_seconds"] = (
+                    time.perf_counter() - start_time
+                )
+
+    def start_prebuild(self, fetch_spec, report=None):
+        """
+        Start building an environment into the cache in a background thread.
+
+        fetch_spec is called in that thread, and returns the contents of the
+        environment.yml to build, or None if there is none. Environments are
+        built with the same arguments as the last one built with this cache
+        directory. A build in enabled() that needs the same environment waits
+        for the prebuild instead of building it again.
+
+        How long the prebuild took is recorded in report, if given. Call
+        finish_prebuild before the build is done, so the prebuild doesn't
+        outlive it - unless the build found it needs a different environment,
+        in which case the prebuild is left to finish in the background.
+        """
+        key_future = Future()
+        done_future = Future()
+        abandoned = threading.Event()
+
+        def run():
+            try:
+                self._prebuild(fetch_spec, key_future, report, abandoned)
+                done_future.set_result(None)
+            except BaseException as e:
+                log.warning(f"Could not build environment alongside the fetch: {e}")
+                if not key_future.done():
+                    key_future.set_result(None)
+                done_future.set_exception(e)
+
+        thread = threading.Thread(target=run, name="environment-prebuild")
+        self.prebuilding = (key_future, done_future, thread, abandoned)
+        thread.start()
+
+    def finish_prebuild(self):
+        """
+        Wait for the prebuild in progress, if any, to be done.
+
+        Even if the build never got to its environment, so it isn't still
+        building while the next build runs - its environment is cached for
+        later builds. Prebuilds of environments the build found it doesn't
+        need aren't waited for.
+        """
+        if self.prebuilding is None:
+            return
+        thread = self.prebuilding[2]
+        self.prebuilding = None
+        if thread.is_alive():
+            log.info("Waiting for environment being built alongside the fetch")
+        thread.join()
+
+    def _wait_for_prebuild(self, key):
+        """
+        Wait for the prebuild in progress, if it is building the environment for key
+        """
+        if self.prebuilding is None:
+            return
+        key_future, done_future, _, abandoned = self.prebuilding
+        if key_future.result() != key:
+            record("environment_prebuild", "unused")
+            # Not worth waiting for, but its environment may be useful to
+            # later builds - and the cache is only ever written atomically
+            log.info("Environment being built alongside the fetch is not needed")
+            abandoned.set()
+            self.prebuilding = None
+            return
+        log.info(f"Waiting for environment {key} being built alongside the fetch")
+        try:
+            done_future.result()
+            record("environment_prebuild", "used")
+        except Exception as e:
+            log.warning(f"Building environment alongside the fetch failed: {e}")
+            record("environment_prebuild", "failed")
+
+    def wrap(self, build_and_pack_emscripten_env):
+        """
+        Wrap jupyterlite-xeus-python's build_and_pack_emscripten_env with this cache
+        """
+
+        @functools.wraps(build_and_pack_emscripten_env)
+        def cached_build_and_pack_emscripten_env(**kwargs):
+            environment_file = kwargs.pop("environment_file", "")
+            key = self.get_key(environment_file, **kwargs)
+            kwargs["environment_file"] = environment_file
+            if key is None:
+                record("environment_cache", "uncacheable")
+                return build_and_pack_emscripten_env(**kwargs)
+
+            self._save_build_args(kwargs)
+            self._wait_for_prebuild(key)
+            entry = self.get(key)
+            if entry is None:
+                log.info(f"Environment {key} not in cache, building it")
+                record("environment_cache", "miss")
+                env_prefix = build_and_pack_emscripten_env(**kwargs)
+                if not env_prefix:
+                    # Nothing to build
+                    return env_prefix
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                entry = self.put(key, kwargs["output_path"], env_prefix)
+            else:
+                log.info(f"Using cached environment {key}")
+                record("environment_cache", "hit")
+                shutil.copytree(
+                    entry / "packed",
+                    kwargs["output_path"],
+                    copy_function=_link_or_copy,
+                    dirs_exist_ok=True,
+                )
+            return entry / "prefix"
+
+        return cached_build_and_pack_emscripten_env
+
+    @contextmanager
+    def enabled(self):
+        """
+        Use this cache for xeus-python environments built inside the with block
+        """
+        try:
+            from jupyterlite_xeus_python import env_build_addon
+        except ImportError:
+            # xeus-python addon not installed, so there is no environment to cache
+            yield
+            return
+
+        original = env_build_addon.build_and_pack_emscripten_env
+        env_build_addon.build_and_pack_emscripten_env = self.wrap(original)
+        try:
+            yield
+        finally:
+            env_build_addon.build_and_pack_emscripten_env = original
@@ -0,0 +1,241 @@
+"""
+Git content provider backed by a local cache of bare mirrors.
+
+repo2docker's Git content provider clones the whole repository from scratch
+for every build. MirroredGit instead keeps one bare mirror per remote URL,
+updates it with an incremental `git fetch`, and makes checkouts from it with
+`git clone --shared` - so repeated builds of the same repo only transfer
+new objects over the network.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+from repo2docker.contentproviders import Git
+from repo2docker.contentproviders.base import ContentProviderException
+from repo2docker.utils import execute_cmd
+
+from .envcache import DEFAULT_CACHE_DIR, _tree_size
+from .report import count, record
+
+log = logging
+
+DEFAULT_MAX_SIZE = int(
+    os.environ.get("REPO2JUPYTERLITE_GIT_CACHE_MAX_SIZE", 10 * 1024 * 1024 * 1024)
+)
+
+
+@contextmanager
+def locked(path, blocking=True):
+    """
+    Hold a lock on path for the duration of the with block.
+
+    Locks are advisory, and are held across processes. Yields False instead
+    of waiting if blocking is False and the lock is held by someone else.
+    Whoever holds the lock may delete path, as long as they do so before
+    releasing it.
+    """
+    while True:
+        with open(path, "a") as f:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                try:
+                    current = os.stat(path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current != os.fstat(f.fileno()).st_ino:
+                    # Deleted by whoever held the lock before us, so locking
+                    # it locks nothing - try again with a new one
+                    continue
+                yield True
+                return
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _object_size(mirror_path):
+    """
+    Return bytes used by objects in git repo at mirror_path
+    """
+    output = subprocess.check_output(
+        ["git", "count-objects", "-v"], cwd=mirror_path
+    ).decode()
+    sizes = dict(line.split(": ", 1) for line in output.splitlines())
+    # Reported in KiB
+    return (int(sizes["size"]) + int(sizes["size-pack"])) * 1024
+
+
+class MirroredGit(Git):
+    """
+    Provide contents of a remote git repository, via a local mirror of it.
+
+    Mirrors live in cache_dir/git, one per remote URL. Each has a lock file
+    next to it that is held exclusively while the mirror is updated and
+    checked out from, so concurrent builds of the same repo are safe.
+    Checkouts borrow the mirror's objects, so that includes updating their
+    submodules - only their working tree is used after that. Mirrors not
+    used recently are evicted once the cache is over max_size bytes.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        super().__init__()
+        self.mirrors_dir = Path(cache_dir) / "git"
+        self.max_size = max_size
+
+    def detect(self, source, ref=None, extra_args=None):
+        spec = super().detect(source, ref, extra_args)
+        # pip style URLs, which git itself doesn't understand
+        if re.match(r"git\+https?://", source):
+            spec["repo"] = source[len("git+") :]
+        return spec
+
+    def get_mirror_path(self, repo):
+        # Hash the URL, as it may contain characters not safe in file names
+        return self.mirrors_dir / (hashlib.sha256(repo.encode()).hexdigest() + ".git")
+
+    def _resolve(self, mirror_path, ref):
+        """
+        Return commit hash ref points to in the mirror, or None if it doesn't exist
+        """
+        try:
+            return (
+                subprocess.check_output(
+                    ["git", "rev-parse", "--quiet", "--verify", f"{ref}^{{commit}}"],
+                    cwd=mirror_path,
+                    stderr=subprocess.DEVNULL,
+                )
+                .decode()
+                .strip()
+            )
+        except subprocess.CalledProcessError:
+            return None
+
+    def _update_mirror(self, repo, ref, mirror_path, yield_output):
+        """
+        Create or update mirror_path so it has ref, returning the hash ref points to
+        """
+        if not mirror_path.exists():
+            tmp_path = mirror_path.with_suffix(f".{os.getpid()}.tmp")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            yield from execute_cmd(
+                ["git", "clone", "--mirror", repo, str(tmp_path)],
+                capture=yield_output,
+            )
+            os.rename(tmp_path, mirror_path)
+            # Objects in the mirror are shared with checkouts, so git must
+            # never garbage collect them on its own
+            subprocess.check_call(["git", "config", "gc.auto", "0"], cwd=mirror_path)
+            record("git_mirror", "clone")
+            count("fetched_bytes", _object_size(mirror_path))
+        elif ref == "HEAD" or self._resolve(mirror_path, ref) != ref:
+            # Branches and tags may have moved, so always fetch unless
+            # ref is a commit hash we already have
+            size_before = _object_size(mirror_path)
+            yield from execute_cmd(
+                ["git", "fetch", "--prune", "--tags", "origin"],
+                cwd=mirror_path,
+                capture=yield_output,
+            )
+            record("git_mirror", "fetch")
+            # Approximate, as pruning can free space too
+            count("fetched_bytes", max(_object_size(mirror_path) - size_before, 0))
+        else:
+            yield f"Commit {ref} already in mirror of {repo}, not fetching\n"
+            record("git_mirror", "hit")
+        return self._resolve(mirror_path, ref)
+
+    def fetch(self, spec, output_dir, yield_output=False):
+        repo = spec["repo"]
+        ref = spec.get("ref") or "HEAD"
+
+        self.mirrors_dir.mkdir(parents=True, exist_ok=True)
+        mirror_path = self.get_mirror_path(repo)
+
+        with locked(mirror_path.with_suffix(".lock")):
+            try:
+                hash = yield from self._update_mirror(
+                    repo, ref, mirror_path, yield_output
+                )
+            except subprocess.CalledProcessError as e:
+                raise ContentProviderException(
+                    f"Failed to fetch repository from {repo}."
+                ) from e
+            if hash is None:
+                raise ValueError(f"Failed to check out ref {ref}")
+            # Mark as recently used
+            os.utime(mirror_path)
+
+            yield from execute_cmd(
+                [
+                    "git",
+                    "clone",
+                    "--shared",
+                    "--no-checkout",
+                    str(mirror_path),
+                    output_dir,
+                ],
+                capture=yield_output,
+            )
+            yield from execute_cmd(
+                ["git", "reset", "--hard", hash], cwd=output_dir, capture=yield_output
+            )
+
+            # Point origin back at the real remote, so relative submodule URLs
+            # resolve correctly
+            yield from execute_cmd(
+                ["git", "remote", "set-url", "origin", repo],
+                cwd=output_dir,
+                capture=yield_output,
+            )
+            # Still locked, as this reads the mirror's objects through the
+            # checkout's alternates - and the mirror must not be evicted
+            # from under it
+            yield from execute_cmd(
+                ["git", "submodule", "update", "--init", "--recursive"],
+                cwd=output_dir,
+                capture=yield_output,
+            )
+        self._sha1 = hash
+
+        self.evict(keep=mirror_path)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used mirrors until the cache fits in max_size.
+
+        Mirrors currently locked by another build are never removed.
+        """
+        mirrors = []
+        for mirror_path in self.mirrors_dir.glob("*.git"):
+            mirrors.append(
+                (mirror_path.stat().st_mtime, _tree_size(mirror_path), mirror_path)
+            )
+        total_size = sum(size for _, size, _ in mirrors)
+        for _, size, mirror_path in sorted(mirrors):
+            if total_size <= self.max_size:
+                break
+            if mirror_path == keep:
+                continue
+            lock_path = mirror_path.with_suffix(".lock")
+            with locked(lock_path, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                log.info(f"Evicting git mirror {mirror_path} from cache")
+                shutil.rmtree(mirror_path, ignore_errors=True)
+                # While still holding it, so nobody else can be using it
+                lock_path.unlink()
+                total_size -= size
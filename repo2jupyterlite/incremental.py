@@ -0,0 +1,299 @@
+"""
+Incremental rebuilds on top of a previous build of the same repo.
+
+Most commits to a repo only change a few notebooks, but a full build redoes
+everything - copying the JupyterLite app, its extensions and environment,
+and indexing every file. Every build records a manifest of its inputs (a
+fingerprint of each file in the repo that goes into it), the settings it was
+built with, and its outputs. Given such a base build, a build whose
+configuration, settings and environment are unchanged starts from hardlinks
+to the base build's outputs, and only copies and re-indexes the contents
+that changed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+
+from .envcache import EnvironmentCache, _link_or_copy
+from .report import record
+
+log = logging
+
+MANIFEST_NAME = ".repo2jupyterlite-manifest.json"
+
+# Bump when the manifest, or what is built from the same inputs, changes
+MANIFEST_VERSION = 2
+
+# Files in the root of the repo that affect the build other than as contents
+CONFIG_FILES = {
+    "environment.yml",
+    "jupyterlite_config.json",
+    "jupyter_lite_config.json",
+    "jupyter-lite.json",
+    "jupyter-lite.ipynb",
+    "overrides.json",
+}
+
+# Directories in the root of the repo that affect the build other than as contents
+CONFIG_DIRS = {"pypi"}
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _get_versions():
+    versions = {"manifest": MANIFEST_VERSION}
+    for package in ("jupyterlite-core", "jupyterlite-xeus-python"):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def _is_input(rel_path, rules, is_dir=False):
+    """
+    Return True if rel_path can affect what is built, given contents rules
+    """
+    if rel_path in CONFIG_FILES or rel_path.split("/", 1)[0] in CONFIG_DIRS:
+        return True
+    return rules is None or not rules.excludes(rel_path, is_dir)
+
+
+def _git_blob_ids(repo_dir):
+    """
+    Return dict of path -> git blob id of files tracked in git repo at repo_dir.
+
+    git already knows these, so no file needs to be read. Only correct for
+    checkouts without local changes. Returns None if repo_dir isn't a git repo.
+    """
+    if not os.path.exists(os.path.join(repo_dir, ".git")):
+        return None
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-files", "--stage", "-z", "--recurse-submodules"],
+            cwd=repo_dir,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    blob_ids = {}
+    for entry in output.decode("utf-8", "surrogateescape").split("\0"):
+        if entry:
+            # '<mode> <blob id> <stage>\t<path>'
+            info, path = entry.split("\t", 1)
+            blob_ids[path] = info.split(" ")[1]
+    return blob_ids
+
+
+def hash_inputs(repo_dir, rules=None, local=False):
+    """
+    Return dict of path (relative to repo_dir) -> fingerprint of files in it.
+
+    Fingerprints change when a file does. For git checkouts we fetched, they
+    are blob ids from git. Files in local directories may have been changed
+    in place, so theirs are their size and modification time. Otherwise,
+    every file is read and hashed.
+
+    If rules is a ContentsRules, files it excludes are left out - other than
+    those that configure the build.
+    """
+    if not local:
+        blob_ids = _git_blob_ids(repo_dir)
+        if blob_ids is not None:
+            return {
+                path: blob_id
+                for path, blob_id in blob_ids.items()
+                if _is_input(path, rules)
+            }
+    inputs = {}
+    for dirpath, dirnames, filenames in os.walk(repo_dir):
+        rel_dir = Path(dirpath).relative_to(repo_dir)
+        dirnames[:] = [
+            name
+            for name in dirnames
+            if name != ".git" and _is_input((rel_dir / name).as_posix(), rules, True)
+        ]
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            rel_path = (rel_dir / name).as_posix()
+            if not os.path.isfile(path) or not _is_input(rel_path, rules):
+                continue
+            if local:
+                st = os.stat(path)
+                inputs[rel_path] = f"{st.st_size}-{st.st_mtime_ns}"
+            else:
+                inputs[rel_path] = _hash_file(path)
+    return inputs
+
+
+def write_manifest(output_dir, inputs, settings):
+    """
+    Record inputs, settings and outputs of the build in output_dir.
+
+    settings is a JSON serializable dict of anything other than the inputs
+    that what was built depends on, like contents rules. inputs may be None,
+    in which case later builds can't be built on top of this one.
+    """
+    outputs = []
+    for dirpath, dirnames, filenames in os.walk(output_dir):
+        for name in filenames:
+            path = Path(dirpath) / name
+            outputs.append(path.relative_to(output_dir).as_posix())
+    manifest = {
+        "versions": _get_versions(),
+        "inputs": inputs,
+        "settings": settings,
+        "outputs": sorted(outputs),
+    }
+    with open(Path(output_dir) / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f)
+
+
+def load_manifest(build_dir):
+    """
+    Return manifest of build in build_dir, or None if it doesn't have one
+    """
+    try:
+        with open(Path(build_dir) / MANIFEST_NAME) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_changed_inputs(manifest, inputs, settings):
+    """
+    Return set of paths changed since the build manifest is from.
+
+    Returns None if the build can not be done incrementally on top of it.
+    """
+    if manifest is None or manifest.get("versions") != _get_versions():
+        return None
+    # Round trip through JSON, so settings compare as they were recorded
+    if manifest.get("settings") != json.loads(json.dumps(settings)):
+        return None
+    base_inputs = manifest.get("inputs")
+    if base_inputs is None:
+        return None
+    changed = {
+        path
+        for path in base_inputs.keys() | inputs.keys()
+        if base_inputs.get(path) != inputs.get(path)
+    }
+    for path in changed:
+        if path in CONFIG_FILES or path.split("/", 1)[0] in CONFIG_DIRS:
+            return None
+    return changed
+
+
+def _update_contents(contents_addon, repo_dir, changed):
+    """
+    Bring contents copied from the base build up to date with repo_dir.
+
+    Copies changed and added files, removes deleted ones, and regenerates the
+    Contents API listings of every directory that had anything change in it.
+    """
+    from jupyterlite_core.constants import ALL_JSON
+
+    files_dir = contents_addon.output_files_dir
+    repo_dir = Path(repo_dir).resolve()
+    wanted = {dest: src for src, dest in contents_addon.file_src_dest}
+    existing = {p for p in files_dir.rglob("*") if not p.is_dir()}
+
+    def is_changed(src):
+        try:
+            return src.relative_to(repo_dir).as_posix() in changed
+        except ValueError:
+            # Symlinked from outside the repo, so we can't tell
+            return True
+
+    touched = []
+    for dest, src in wanted.items():
+        if dest not in existing or is_changed(src):
+            # Unlinks the destination first, so never modifies the base build
+            contents_addon.copy_one(src, dest)
+            touched.append(dest)
+    for path in existing - wanted.keys():
+        path.unlink()
+        touched.append(path)
+
+    # Remove directories left empty, along with their listings
+    for dirpath, dirnames, filenames in os.walk(files_dir, topdown=False):
+        path = Path(dirpath)
+        if path != files_dir and not any(path.iterdir()):
+            path.rmdir()
+            stem = path.relative_to(files_dir)
+            shutil.rmtree(contents_addon.api_dir / stem, ignore_errors=True)
+
+    # Listings have the size and modification time of their children, so
+    # every parent of anything touched needs a new one
+    listing_dirs = set()
+    for path in touched:
+        for parent in path.parents:
+            if parent == files_dir.parent:
+                break
+            listing_dirs.add(parent)
+    for output_file_dir in sorted(listing_dirs):
+        if not output_file_dir.exists():
+            continue
+        api_path = contents_addon.api_dir / output_file_dir.relative_to(files_dir)
+        api_path = api_path / ALL_JSON
+        # Linked from the base build, so replace rather than overwrite it
+        if api_path.exists():
+            api_path.unlink()
+        contents_addon.one_contents_path(output_file_dir, api_path)
+    return len(touched)
+
+
+def build_incrementally(app, repo_dir, output_dir, base_build, inputs, settings):
+    """
+    Build repo_dir into output_dir on top of base_build, if possible.
+
+    app is an initialized LiteBuildApp for the build, and settings are what
+    it is built with (see write_manifest). Returns True if the
+    build was done incrementally, and False if a full build is needed - in
+    which case output_dir is left untouched.
+    """
+    manifest = load_manifest(base_build)
+    changed = get_changed_inputs(manifest, inputs, settings)
+    manager = app.lite_manager
+    contents_addon = manager._addons.get("contents")
+    if (
+        changed is None
+        or contents_addon is None
+        # Timestamps of files linked from the base build would be changed
+        or manager.source_date_epoch is not None
+    ):
+        log.info(f"Can not build incrementally on top of {base_build}")
+        return False
+    if EnvironmentCache().get_key(Path(repo_dir) / "environment.yml") is None:
+        # Environment includes packages from the repo itself
+        log.info("Environment depends on contents, can not build incrementally")
+        return False
+
+    log.info(f"Building incrementally on top of {base_build}, {len(changed)} changes")
+    try:
+        for path in manifest["outputs"]:
+            dest = Path(output_dir) / path
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            _link_or_copy(Path(base_build) / path, dest)
+        updated = _update_contents(contents_addon, repo_dir, changed)
+    except OSError as e:
+        # The base build may have been removed from under us
+        log.warning(f"Incremental build on top of {base_build} failed: {e}")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        return False
+    record("incremental_base", str(base_build))
+    record("incremental_updated_files", updated)
+    return True
@@ -0,0 +1,241 @@
+"""
+Routing sources to the content provider that can fetch them.
+
+repo2docker picks a content provider by calling detect() on each one in turn
+until one matches. Some of them resolve DOIs or download lists of known
+installations over the network while detecting, so even a plain GitHub build
+paid for those. ProviderRegistry instead keeps an index of which providers
+handle which URL schemes, hostnames and DOI prefixes, and only probes the
+providers a source routes to. URLs that are unmistakably git remotes - ending
+in .git, or scp style like git@host:repo - go straight to git. Other URLs
+that route nowhere fall back to probing the providers not in the index, in
+order, and then git. Anything else that
+is not a local directory can not be fetched, and is an error.
+
+Third party content providers are added with entry points in the
+`repo2jupyterlite.content_providers` group, pointing to a content provider
+class. Optional `schemes`, `hostnames` and `doi_prefixes` class attributes
+(lists of strings) add it to the index - otherwise it is only probed for
+URLs that route nowhere else.
+"""
+
+import logging
+import os
+import re
+from collections import OrderedDict
+from importlib.metadata import entry_points
+from urllib.parse import urlparse
+
+from repo2docker import contentproviders
+from repo2docker.utils import is_doi, normalize_doi
+
+from .archive import DEFAULT_API_BASE_PATHS, GitHubArchive
+from .gitcache import MirroredGit
+from .report import count
+
+log = logging
+
+ENTRYPOINT_GROUP = "repo2jupyterlite.content_providers"
+
+# How many detection results we remember
+DETECTED_CACHE_SIZE = 1024
+
+
+def _get_hostname(source):
+    """
+    Return hostname of source, if it is a URL or scp style git remote
+    """
+    m = re.fullmatch(r"[\w.-]+@(?P<hostname>[\w.-]+):(?!//).*", source)
+    if m is not None:
+        return m["hostname"].lower()
+    return urlparse(source).hostname
+
+
+def _is_git_remote(source):
+    """
+    Return True if source can only be a git remote
+    """
+    if re.fullmatch(r"[\w.-]+@[\w.-]+:(?!//).*", source):
+        return True
+    return urlparse(source).path.rstrip("/").endswith(".git")
+
+
+def _is_remote(source):
+    """
+    Return True if source looks like something git could clone
+    """
+    return "://" in source or _get_hostname(source) is not None
+
+
+class ProviderRegistry:
+    """
+    Content providers, and an index of which sources route to which of them.
+    """
+
+    def __init__(self):
+        # Providers for local directories
+        self.local = []
+        # scheme / hostname / DOI registrant (like '10.5281') -> providers
+        self.by_scheme = {}
+        self.by_hostname = {}
+        self.by_doi_prefix = {}
+        # Providers that resolve DOIs we don't know the prefix of
+        self.doi_resolvers = []
+        # Providers probed for URLs that route nowhere else, in order
+        self.fallback = []
+        # Provider matching any remote source, probed last
+        self.catch_all = None
+        # (source, ref) -> (provider class, spec)
+        self.detected = OrderedDict()
+        self.entry_points_loaded = False
+
+    def register(
+        self,
+        provider_class,
+        schemes=(),
+        hostnames=(),
+        doi_prefixes=(),
+        resolves_dois=False,
+        fallback=False,
+    ):
+        """
+        Add provider_class to the registry, routing sources to it as given.
+
+        Providers registered earlier are probed first.
+        """
+        for scheme in schemes:
+            self.by_scheme.setdefault(scheme.lower(), []).append(provider_class)
+        for hostname in hostnames:
+            self.by_hostname.setdefault(hostname.lower(), []).append(provider_class)
+        for doi_prefix in doi_prefixes:
+            self.by_doi_prefix.setdefault(doi_prefix, []).append(provider_class)
+        if resolves_dois:
+            self.doi_resolvers.append(provider_class)
+        if fallback:
+            self.fallback.append(provider_class)
+
+    def load_entry_points(self):
+        """
+        Register content providers from entry points, once
+        """
+        if self.entry_points_loaded:
+            return
+        self.entry_points_loaded = True
+        for ep in entry_points(group=ENTRYPOINT_GROUP):
+            try:
+                provider_class = ep.load()
+            except Exception as e:
+                log.warning(f"Could not load content provider {ep.name}: {e}")
+                continue
+            schemes = getattr(provider_class, "schemes", ())
+            hostnames = getattr(provider_class, "hostnames", ())
+            doi_prefixes = getattr(provider_class, "doi_prefixes", ())
+            self.register(
+                provider_class,
+                schemes=schemes,
+                hostnames=hostnames,
+                doi_prefixes=doi_prefixes,
+                fallback=not (schemes or hostnames or doi_prefixes),
+            )
+
+    def route(self, source):
+        """
+        Return list of provider classes that may be able to fetch source, in order
+        """
+        self.load_entry_points()
+        if os.path.isdir(source):
+            return self.local
+        if is_doi(source):
+            registrant = normalize_doi(source).split("/", 1)[0]
+            return self.by_doi_prefix.get(registrant, self.doi_resolvers)
+        if ":" in source:
+            scheme = source.split(":", 1)[0].lower()
+            if scheme in self.by_scheme:
+                return self.by_scheme[scheme]
+        hostname = _get_hostname(source)
+        if hostname in self.by_hostname:
+            return self.by_hostname[hostname]
+        if not _is_remote(source):
+            # Not a directory, DOI or URL, so nothing can fetch it
+            return []
+        if _is_git_remote(source) and self.catch_all:
+            return [self.catch_all]
+        return self.fallback + ([self.catch_all] if self.catch_all else [])
+
+    def detect(self, source, ref, make_provider):
+        """
+        Return (provider, spec) of the provider that can fetch source at ref.
+
+        make_provider is called with a provider class to create an instance
+        of it. Returns (None, None) if no provider can fetch source.
+        """
+        key = (source, ref)
+        if key in self.detected:
+            self.detected.move_to_end(key)
+            provider_class, spec = self.detected[key]
+            count("content_provider_cached")
+            return make_provider(provider_class), spec
+
+        for provider_class in self.route(source):
+            provider = make_provider(provider_class)
+            count("content_provider_probes")
+            spec = provider.detect(source, ref=ref)
+            if spec is not None:
+                self.detected[key] = (provider_class, spec)
+                if len(self.detected) > DETECTED_CACHE_SIZE:
+                    self.detected.popitem(last=False)
+                return provider, spec
+        return None, None
+
+
+def make_default_registry():
+    """
+    Return registry of the content providers repo2jupyterlite supports
+    """
+    registry = ProviderRegistry()
+    registry.local.append(contentproviders.Local)
+    registry.register(GitHubArchive, hostnames=DEFAULT_API_BASE_PATHS.keys())
+    registry.register(
+        MirroredGit,
+        schemes=["git", "ssh", "git+ssh", "git+https", "git+http"],
+        hostnames=[
+            *DEFAULT_API_BASE_PATHS.keys(),
+            "gitlab.com",
+            "bitbucket.org",
+            "codeberg.org",
+        ],
+    )
+    registry.register(
+        contentproviders.Zenodo,
+        hostnames=["zenodo.org", "sandbox.zenodo.org", "data.caltech.edu"],
+        doi_prefixes=["10.5281", "10.22002"],
+        resolves_dois=True,
+    )
+    registry.register(
+        contentproviders.Figshare,
+        hostnames=["figshare.com"],
+        doi_prefixes=["10.6084"],
+        resolves_dois=True,
+    )
+    # Installations are too many and change too often to list, so only
+    # Harvard's is indexed
+    registry.register(
+        contentproviders.Dataverse,
+        hostnames=["dataverse.harvard.edu"],
+        doi_prefixes=["10.7910"],
+        resolves_dois=True,
+        fallback=True,
+    )
+    registry.register(
+        contentproviders.Hydroshare,
+        hostnames=["hydroshare.org", "www.hydroshare.org"],
+        doi_prefixes=["10.4211"],
+        resolves_dois=True,
+    )
+    registry.register(contentproviders.Swhid, schemes=["swh"])
+    registry.register(contentproviders.Mercurial, fallback=True)
+    registry.catch_all = MirroredGit
+    return registry
+
+
+registry = make_default_registry()
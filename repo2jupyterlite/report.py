@@ -0,0 +1,225 @@
+"""
+Structured reports of where the time and resources of a build went.
+
+A BuildReport records wall time, CPU time and peak memory use of each phase
+of a build - detecting the content provider, fetching, building, and each
+jupyterlite addon's steps within the build - along with counters like bytes
+fetched, and whether caches were hit.
+
+Code deep inside a build (content providers, the environment cache) records
+into the active report with the module level `record`, `count` and `phase`
+functions, which do nothing if no report is active.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+
+# Report active in this process, if any
+_active = None
+
+
+def record(name, value):
+    """
+    Record value as name in the active report, if there is one
+    """
+    if _active is not None:
+        _active.counters[name] = value
+
+
+def phase(name):
+    """
+    Record the with block as phase name in the active report, if there is one
+    """
+    if _active is None:
+        return nullcontext()
+    return _active.phase(name)
+
+
+def count(name, amount=1):
+    """
+    Add amount to counter name in the active report, if there is one
+    """
+    if _active is not None:
+        _active.counters[name] = _active.counters.get(name, 0) + amount
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process, returning False if that isn't possible
+    """
+    try:
+        # Resets VmHWM, see proc(5)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _get_peak_rss():
+    """
+    Return peak RSS of this process in bytes, since it was last reset
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak over the whole life of the process, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _get_cpu_time():
+    """
+    Return CPU time used by this process and its finished subprocesses
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class BuildReport:
+    """
+    Report of the phases of a single build, and counters about it.
+
+    Phases may nest. A phase's peak RSS covers its nested phases too, and is
+    only per phase where the kernel lets us reset it - otherwise it is the
+    peak over the life of the process so far. Phases entered more than once,
+    like an addon's steps, are added up.
+
+    If profile_path is given, the build is also profiled with cProfile while
+    the report is active, and the stats dumped to profile_path.
+    """
+
+    def __init__(self, profile_path=None):
+        self.profile_path = profile_path
+        # name -> {"wall": seconds, "cpu": seconds, "peak_rss": bytes, "count": n}
+        self.phases = {}
+        self.counters = {}
+        # Peak RSS seen by each phase in progress, innermost last
+        self._stack = []
+
+    @contextmanager
+    def active(self):
+        """
+        Make this the report record() and count() record into
+        """
+        global _active
+        previous, _active = _active, self
+        profiler = None
+        if self.profile_path:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield self
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+            _active = previous
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Record wall time, CPU time and peak RSS of the with block as phase name
+        """
+        # Peak RSS of the outer phase so far, before we reset it
+        if self._stack:
+            self._stack[-1] = max(self._stack[-1], _get_peak_rss())
+        _reset_peak_rss()
+        self._stack.append(0)
+        start_wall = time.perf_counter()
+        start_cpu = _get_cpu_time()
+        try:
+            yield
+        finally:
+            peak_rss = max(self._stack.pop(), _get_peak_rss())
+            if self._stack:
+                self._stack[-1] = max(self._stack[-1], peak_rss)
+            phase = self.phases.setdefault(
+                name, {"wall": 0.0, "cpu": 0.0, "peak_rss": 0, "count": 0}
+            )
+            phase["wall"] += time.perf_counter() - start_wall
+            phase["cpu"] += _get_cpu_time() - start_cpu
+            phase["peak_rss"] = max(phase["peak_rss"], peak_rss)
+            phase["count"] += 1
+
+    def _time_action(self, action, name):
+        """
+        Wrap doit python action so it is timed as phase name
+        """
+        if isinstance(action, tuple):
+            return (self._time_action(action[0], name), *action[1:])
+        if not callable(action):
+            # Shell commands, counted in the surrounding phase only
+            return action
+
+        # wraps, so doit still sees the signature of the original action
+        @functools.wraps(action)
+        def timed_action(*args, **kwargs):
+            with self.phase(name):
+                return action(*args, **kwargs)
+
+        return timed_action
+
+    @contextmanager
+    def timing_addons(self):
+        """
+        Time the steps of each jupyterlite addon in builds in the with block.
+
+        Steps are recorded as 'build:<hook>:<addon>' phases, like
+        'build:post_build:contents'.
+        """
+        from jupyterlite_core.manager import LiteManager
+
+        original = LiteManager._gather_tasks
+
+        def _gather_tasks(manager, attr, prev_attr):
+            gather = original(manager, attr, prev_attr)
+
+            # wraps, so doit still sees when tasks should be created
+            @functools.wraps(gather)
+            def timed_gather():
+                for task in gather():
+                    addon = task["name"].split(":", 1)[0]
+                    if addon.startswith(manager.task_prefix):
+                        addon = addon[len(manager.task_prefix) :]
+                    name = f"build:{attr}:{addon}"
+                    task["actions"] = [
+                        self._time_action(action, name)
+                        for action in task.get("actions") or []
+                    ]
+                    yield task
+
+            return timed_gather
+
+        LiteManager._gather_tasks = _gather_tasks
+        try:
+            yield
+        finally:
+            LiteManager._gather_tasks = original
+
+    def to_dict(self):
+        return {"phases": self.phases, "counters": self.counters}
+
+    def record_output(self, output_dir):
+        """
+        Count files in, and total size of, output_dir
+        """
+        files = size = 0
+        for dirpath, dirnames, filenames in os.walk(output_dir):
+            for name in filenames:
+                files += 1
+                size += os.lstat(os.path.join(dirpath, name)).st_size
+        self.counters["output_files"] = files
+        self.counters["output_bytes"] = size
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
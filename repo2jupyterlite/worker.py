@@ -0,0 +1,114 @@
+"""
+Long-lived repo2jupyterlite builder processes.
+
+Starting a fresh `repo2jupyterlite` process for every build means paying for
+interpreter startup and importing jupyterlite, its addons, traitlets, doit
+and repo2docker every single time. Builder processes instead import all of
+these once in `initialize`, and then run many builds with `run_build`.
+
+Meant to be used as the initializer and function of a
+`concurrent.futures.ProcessPoolExecutor`.
+"""
+
+import os
+import sys
+import traceback
+from contextlib import contextmanager
+from importlib.metadata import entry_points
+
+
+def initialize():
+    """
+    Import everything a build needs, so builds themselves don't have to
+    """
+    import jupyterlite_core.app  # noqa: F401
+    from jupyterlite_core.constants import ADDON_ENTRYPOINT
+
+    from . import app  # noqa: F401
+
+    for ep in entry_points(group=ADDON_ENTRYPOINT):
+        try:
+            ep.load()
+        except Exception:
+            # Let the build itself report broken addons
+            pass
+
+
+@contextmanager
+def redirect_output(log_path):
+    """
+    Send everything written to stdout and stderr to log_path.
+
+    Redirects at the file descriptor level, so output of subprocesses (like
+    git or mamba) ends up in the log too. Only safe because a builder
+    process runs one build at a time.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = [os.dup(1), os.dup(2)]
+    with open(log_path, "ab", buffering=0) as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+
+
+def run_build(
+    url,
+    ref,
+    output_dir,
+    log_path,
+    report_path=None,
+    base_build=None,
+    cache_dir=None,
+    record_inputs=True,
+):
+    """
+    Fetch and build url at ref into output_dir, logging to log_path.
+
+    Git mirrors and environments are cached in cache_dir, or the default
+    cache directory if not given.
+
+    If base_build is given, only what changed since that build is rebuilt
+    when possible. If record_inputs is False, this build can't be the
+    base_build of later ones.
+
+    If report_path is given, a JSON report of the build (see
+    repo2jupyterlite.report) is written there - even if the build fails.
+
+    Raises RuntimeError if the build fails. The original exception may not
+    be picklable, so it is not sent back to the parent process as is.
+    """
+    from .app import fetch_and_build
+    from .envcache import DEFAULT_CACHE_DIR, EnvironmentCache
+    from .report import BuildReport
+
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    report = BuildReport()
+    with redirect_output(log_path):
+        try:
+            fetch_and_build(
+                url,
+                ref,
+                output_dir,
+                EnvironmentCache(cache_dir),
+                cache_dir,
+                report=report,
+                base_build=base_build,
+                record_inputs=record_inputs,
+            )
+        except BaseException as e:
+            traceback.print_exc()
+            report.counters["error"] = str(e)
+            raise RuntimeError(f"Building {url} at {ref} failed: {e}") from None
+        finally:
+            if report_path:
+                report.write(report_path)
@@ -1,24 +1,42 @@
-from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+from tornado.httpclient import HTTPError, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+import asyncio
 import json
+import re
 from traitlets.config import LoggingConfigurable
 import time
 import os
-from traitlets import Unicode, default
+from traitlets import Float, Integer, Unicode, default
+from prometheus_client import Gauge
 from datetime import timedelta
-from .utils import Cache
+from .utils import make_cache
+
+GITHUB_RATE_LIMIT = Gauge(
+    "repoproviders_github_rate_limit_remaining", "GitHub rate limit remaining"
+)
 
 
 class GitHubRepoProvider(LoggingConfigurable):
     name = Unicode("GitHub")
 
     # shared cache for resolved refs
-    cache = Cache(1024)
+    cache = make_cache("github-refs", 1024)
 
     # separate cache with max age for 404 results
     # 404s don't have ETags, so we want them to expire at some point
     # to avoid caching a 404 forever since e.g. a missing repo or branch
     # may be created later
-    cache_404 = Cache(1024, max_age=300)
+    cache_404 = make_cache("github-refs-404", 1024, max_age=300)
+
+    # api_url -> task revalidating a stale cache entry for it
+    _revalidations = {}
+
+    # (api_url, etag) -> future for an API request in progress
+    _in_flight_requests = {}
+
+    # HTTP client shared by all instances, with its IOLoop
+    _http_client = None
 
     hostname = Unicode(
         "github.com",
@@ -43,6 +61,22 @@ class GitHubRepoProvider(LoggingConfigurable):
         """,
     )
 
+    graphql_url = Unicode(
+        "{api_base_path}/graphql",
+        config=True,
+        help="""URL of the GitHub GraphQL API, used to resolve refs in bulk
+
+        Can use {api_base_path} and {hostname} for substitution.
+        For GitHub Enterprise, usually 'https://{hostname}/api/graphql'.
+        """,
+    )
+
+    graphql_batch_size = Integer(
+        100,
+        config=True,
+        help="""Number of refs to resolve per GraphQL query""",
+    )
+
     client_id = Unicode(
         config=True,
         help="""GitHub client id for authentication with the GitHub API
@@ -52,6 +86,72 @@ class GitHubRepoProvider(LoggingConfigurable):
         """,
     )
 
+    ref_freshness = Float(
+        config=True,
+        help="""Seconds a cached ref resolution is used for without checking GitHub
+
+        Past this, the cached commit is still returned immediately, while it is
+        revalidated in the background. Set to 0 to always check with GitHub
+        before returning.
+        Loaded from GITHUB_REF_FRESHNESS env by default, or 60 seconds.
+        """,
+    )
+
+    @default("ref_freshness")
+    def _ref_freshness_default(self):
+        return float(os.getenv("GITHUB_REF_FRESHNESS", 60))
+
+    http_client_backend = Unicode(
+        config=True,
+        help="""HTTP client to make GitHub API requests with
+
+        'simple' (tornado's pure Python client) or 'curl' (needs pycurl).
+        curl keeps connections to the API alive between requests.
+        Loaded from GITHUB_HTTP_CLIENT env by default, or 'simple'.
+        """,
+    )
+
+    @default("http_client_backend")
+    def _http_client_backend_default(self):
+        return os.getenv("GITHUB_HTTP_CLIENT", "simple")
+
+    http_max_clients = Integer(
+        config=True,
+        help="""Maximum number of concurrent GitHub API requests
+
+        Further requests are queued.
+        Loaded from GITHUB_HTTP_MAX_CLIENTS env by default, or 10.
+        """,
+    )
+
+    @default("http_max_clients")
+    def _http_max_clients_default(self):
+        return int(os.getenv("GITHUB_HTTP_MAX_CLIENTS", 10))
+
+    http_connect_timeout = Float(
+        config=True,
+        help="""Timeout in seconds for connecting to the GitHub API
+
+        Loaded from GITHUB_HTTP_CONNECT_TIMEOUT env by default, or 5.
+        """,
+    )
+
+    @default("http_connect_timeout")
+    def _http_connect_timeout_default(self):
+        return float(os.getenv("GITHUB_HTTP_CONNECT_TIMEOUT", 5))
+
+    http_request_timeout = Float(
+        config=True,
+        help="""Timeout in seconds for a whole GitHub API request
+
+        Loaded from GITHUB_HTTP_REQUEST_TIMEOUT env by default, or 20.
+        """,
+    )
+
+    @default("http_request_timeout")
+    def _http_request_timeout_default(self):
+        return float(os.getenv("GITHUB_HTTP_REQUEST_TIMEOUT", 20))
+
     @default("client_id")
     def _client_id_default(self):
         return os.getenv("GITHUB_CLIENT_ID", "")
@@ -117,8 +217,51 @@ class GitHubRepoProvider(LoggingConfigurable):
         self.repo = repo
         self.unresolved_ref = unresolved_ref
 
+    def _get_http_client(self):
+        """
+        Return the HTTP client shared by all instances for the current IOLoop
+        """
+        cls = GitHubRepoProvider
+        io_loop = IOLoop.current()
+        if cls._http_client is not None and cls._http_client.io_loop is io_loop:
+            return cls._http_client
+
+        client_class = SimpleAsyncHTTPClient
+        if self.http_client_backend == "curl":
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+            except ImportError:
+                self.log.warning("pycurl not installed, using simple HTTP client")
+            else:
+                client_class = CurlAsyncHTTPClient
+        # force_instance, so we don't change the client used by anything else
+        cls._http_client = client_class(
+            force_instance=True,
+            max_clients=self.http_max_clients,
+            defaults=dict(
+                connect_timeout=self.http_connect_timeout,
+                request_timeout=self.http_request_timeout,
+            ),
+        )
+        return cls._http_client
+
     async def _github_api_request(self, api_url, etag=None):
-        client = AsyncHTTPClient()
+        """
+        Make a GitHub API request, sharing it with identical requests in flight
+        """
+        key = (api_url, etag)
+        future = self._in_flight_requests.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._do_github_api_request(api_url, etag))
+            self._in_flight_requests[key] = future
+            future.add_done_callback(lambda f: self._in_flight_requests.pop(key, None))
+        else:
+            self.log.debug("Joining request in flight for %s", api_url)
+        # shield, so one caller going away doesn't cancel it for everyone
+        return await asyncio.shield(future)
+
+    async def _do_github_api_request(self, api_url, etag=None):
+        client = self._get_http_client()
 
         request_kwargs = {}
         if self.client_id and self.client_secret:
@@ -176,8 +319,8 @@ class GitHubRepoProvider(LoggingConfigurable):
             rate_limit = int(resp.headers["x-ratelimit-limit"])
             reset_timestamp = int(resp.headers["x-ratelimit-reset"])
 
-            # # record with prometheus
-            # GITHUB_RATE_LIMIT.set(remaining)
+            # record with prometheus
+            GITHUB_RATE_LIMIT.set(remaining)
 
             # log at different levels, depending on remaining fraction
             fraction = remaining / rate_limit
@@ -204,12 +347,198 @@ class GitHubRepoProvider(LoggingConfigurable):
         if hasattr(self, "resolved_ref"):
             return self.resolved_ref
 
-        api_url = "{api_base_path}/repos/{user}/{repo}/commits/{ref}".format(
+        api_url = self._get_commit_api_url(self.user, self.repo, self.unresolved_ref)
+        cached = self.cache.get(api_url)
+        if cached:
+            age = time.time() - cached.get("checked", 0)
+            if age < self.ref_freshness or (
+                # Commit hashes always resolve to themselves
+                re.fullmatch(r"[0-9a-f]{40}", self.unresolved_ref)
+                and cached["sha"] == self.unresolved_ref
+            ):
+                self.log.debug("Fresh cache hit for %s", api_url)
+                self.resolved_ref = cached["sha"]
+                return self.resolved_ref
+            if self.cache_404.get(api_url):
+                # Deleted since it was cached, so don't serve or revalidate it
+                self.log.debug("Cache hit for 404 on %s", api_url)
+                self._forget_ref(api_url)
+                self.resolved_ref = None
+                return self.resolved_ref
+            if self.ref_freshness:
+                # Don't make users wait for GitHub, serve what we have
+                self.log.debug("Stale cache hit for %s, revalidating", api_url)
+                self._revalidate(api_url)
+                self.resolved_ref = cached["sha"]
+                return self.resolved_ref
+
+        self.resolved_ref = await self._fetch_resolved_ref(api_url)
+        return self.resolved_ref
+
+    def _get_commit_api_url(self, user, repo, ref):
+        """
+        Return REST API URL ref is resolved with, which is also its cache key
+        """
+        return "{api_base_path}/repos/{user}/{repo}/commits/{ref}".format(
             api_base_path=self.api_base_path.format(hostname=self.hostname),
-            user=self.user,
-            repo=self.repo,
-            ref=self.unresolved_ref,
+            user=user,
+            repo=repo,
+            ref=ref,
+        )
+
+    async def resolve_refs(self, refs):
+        """
+        Resolve many refs at once with the GitHub GraphQL API.
+
+        refs is a list of (user, repo, ref) tuples. Results are put in the same
+        caches get_resolved_ref uses, so this can be used to prewarm them.
+
+        Returns (resolved, rate_limit). resolved is a dict of
+        (user, repo, ref) -> commit hash, or None if there is no such ref.
+        Refs GitHub failed to look up for other reasons (like timeouts or
+        missing permissions) are left out, and not cached. rate_limit has the total 'cost' of the queries in rate limit points,
+        and the 'remaining' points and 'limit' as of the last query.
+
+        Needs access_token, as the GraphQL API does not allow anonymous use.
+        """
+        if not self.access_token:
+            raise ValueError("Resolving refs with GraphQL needs an access token")
+
+        graphql_url = self.graphql_url.format(
+            api_base_path=self.api_base_path.format(hostname=self.hostname),
+            hostname=self.hostname,
+        )
+        refs = list(dict.fromkeys(refs))
+        resolved = {}
+        rate_limit = {"cost": 0, "remaining": None, "limit": None}
+        for start in range(0, len(refs), self.graphql_batch_size):
+            batch = refs[start : start + self.graphql_batch_size]
+            data, errors = await self._graphql_request(graphql_url, batch)
+            if data.get("rateLimit"):
+                rate_limit["cost"] += data["rateLimit"]["cost"]
+                rate_limit["remaining"] = data["rateLimit"]["remaining"]
+                rate_limit["limit"] = data["rateLimit"]["limit"]
+                GITHUB_RATE_LIMIT.set(rate_limit["remaining"])
+
+            # Field (like 'r3') -> types of errors looking it up
+            error_types = {}
+            for error in errors:
+                field = (error.get("path") or [None])[0]
+                error_types.setdefault(field, set()).add(error.get("type"))
+
+            for i, (user, repo, ref) in enumerate(batch):
+                api_url = self._get_commit_api_url(user, repo, ref)
+                types = error_types.get(f"r{i}", set())
+                if data.get(f"r{i}") is None and not types:
+                    # Errors not about any one field may be why it is missing
+                    types = error_types.get(None, set())
+                if types - {"NOT_FOUND"}:
+                    # Possibly transient, so don't hide the repo behind a 404
+                    self.log.warning(
+                        "Could not resolve %s/%s ref %s with GraphQL: %s",
+                        user,
+                        repo,
+                        ref,
+                        types,
+                    )
+                    continue
+                obj = (data.get(f"r{i}") or {}).get("object") or {}
+                # Annotated tags point to a tag object, which points to the commit
+                sha = (obj.get("target") or obj).get("oid")
+                resolved[(user, repo, ref)] = sha
+                if sha is None:
+                    self.cache_404.set(api_url, True)
+                    self._forget_ref(api_url)
+                else:
+                    self.cache.set(
+                        api_url, {"etag": None, "sha": sha, "checked": time.time()}
+                    )
+
+        self.log.info(
+            "Resolved %i refs with GraphQL, costing %i points. %s/%s remaining.",
+            len(refs),
+            rate_limit["cost"],
+            rate_limit["remaining"],
+            rate_limit["limit"],
+        )
+        return resolved, rate_limit
+
+    async def _graphql_request(self, graphql_url, batch):
+        """
+        Look up commits of a batch of (user, repo, ref) in one GraphQL query
+
+        Returns (data, errors), as errors about some refs come with data
+        about the others.
+        """
+        # Pass everything as variables, so nothing needs escaping
+        params = []
+        fields = []
+        variables = {}
+        for i, (user, repo, ref) in enumerate(batch):
+            params.append(f"$o{i}: String!, $n{i}: String!, $e{i}: String!")
+            fields.append(
+                f"r{i}: repository(owner: $o{i}, name: $n{i}) {{"
+                f" object(expression: $e{i}) {{"
+                " ... on Commit { oid }"
+                " ... on Tag { target { ... on Commit { oid } } }"
+                " } }"
+            )
+            variables.update({f"o{i}": user, f"n{i}": repo, f"e{i}": ref})
+        query = "query({}) {{ rateLimit {{ cost remaining limit }} {} }}".format(
+            ", ".join(params), " ".join(fields)
+        )
+
+        req = HTTPRequest(
+            graphql_url,
+            method="POST",
+            headers={"Authorization": f"bearer {self.access_token}"},
+            body=json.dumps({"query": query, "variables": variables}),
+            user_agent="BinderHub",
         )
+        resp = await self._get_http_client().fetch(req)
+        result = json.loads(resp.body.decode("utf-8"))
+        # Missing repos are reported as errors too, alongside partial data
+        if not result.get("data"):
+            raise ValueError(f"GraphQL query failed: {result.get('errors')}")
+        return result["data"], result.get("errors") or []
+
+    def _forget_ref(self, api_url):
+        """
+        Remove cached resolution of api_url, if any
+        """
+        try:
+            self.cache.pop(api_url)
+        except KeyError:
+            pass
+
+    def _revalidate(self, api_url):
+        """
+        Refresh cache entry for api_url in the background.
+
+        Only one revalidation per api_url runs at a time. If it fails, the
+        stale entry is left in place.
+        """
+        if api_url in self._revalidations:
+            return
+
+        async def revalidate():
+            try:
+                await self._fetch_resolved_ref(api_url)
+            except Exception:
+                self.log.exception("Failed to revalidate %s", api_url)
+                cached = self.cache.get(api_url)
+                if cached:
+                    # Keep using it, and try again once it is stale again
+                    self.cache.set(api_url, {**cached, "checked": time.time()})
+            finally:
+                self._revalidations.pop(api_url, None)
+
+        self._revalidations[api_url] = asyncio.ensure_future(revalidate())
+
+    async def _fetch_resolved_ref(self, api_url):
+        """
+        Resolve ref with a (conditional) GitHub API request, updating the caches
+        """
         self.log.debug("Fetching %s", api_url)
         cached = self.cache.get(api_url)
         if cached:
@@ -226,13 +555,14 @@ class GitHubRepoProvider(LoggingConfigurable):
         if resp is None:
             self.log.debug("Caching 404 on %s", api_url)
             self.cache_404.set(api_url, True)
+            # e.g. a deleted branch, which must not resolve to its old commit
+            self._forget_ref(api_url)
             return None
         if resp.code == 304:
             self.log.info("Using cached ref for %s: %s", api_url, cached["sha"])
-            self.resolved_ref = cached["sha"]
             # refresh cache entry
-            self.cache.move_to_end(api_url)
-            return self.resolved_ref
+            self.cache.set(api_url, {**cached, "checked": time.time()})
+            return cached["sha"]
         elif cached:
             self.log.debug("Cache outdated for %s", api_url)
 
@@ -240,18 +570,17 @@ class GitHubRepoProvider(LoggingConfigurable):
         if "sha" not in ref_info:
             # TODO: Figure out if we should raise an exception instead?
             self.log.warning("No sha for %s in %s", api_url, ref_info)
-            self.resolved_ref = None
             return None
-        # store resolved ref and cache for later
-        self.resolved_ref = ref_info["sha"]
+        # cache resolved ref for later
         self.cache.set(
             api_url,
             {
                 "etag": resp.headers.get("ETag"),
-                "sha": self.resolved_ref,
+                "sha": ref_info["sha"],
+                "checked": time.time(),
             },
         )
-        return self.resolved_ref
+        return ref_info["sha"]
 
     async def get_resolved_spec(self):
         """
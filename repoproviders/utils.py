@@ -1,15 +1,41 @@
 from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
 import time
 
+from prometheus_client import Counter
+
+log = logging
+
+CACHE_EVENTS = Counter(
+    "repoproviders_cache_events_total",
+    "Lookups in named caches, by result - hit, miss, or expired",
+    ["cache", "event"],
+)
+
+# Sentinel for missing values, as None can be cached
+_missing = object()
+
 
 class Cache(OrderedDict):
-    """Basic LRU Cache with get/set"""
+    """Basic LRU Cache with get/set
+
+    If name is given, hits, misses and expiries are counted in CACHE_EVENTS.
+    """
 
-    def __init__(self, max_size=1024, max_age=0):
+    def __init__(self, max_size=1024, max_age=0, name=None):
         self.max_size = max_size
         self.max_age = max_age
+        self.name = name
         self._ages = {}
 
+    def _count(self, event):
+        if self.name is not None:
+            CACHE_EVENTS.labels(cache=self.name, event=event).inc()
+
     def _now(self):
         return time.perf_counter()
 
@@ -18,6 +44,7 @@ class Cache(OrderedDict):
             return False
         if self._ages[key] + self.max_age < self._now():
             self.pop(key)
+            self._count("expired")
             return True
         return False
 
@@ -26,8 +53,11 @@ class Cache(OrderedDict):
 
         same as dict.get
         """
-        if key in self and not self._check_expired(key):
+        if key not in self:
+            self._count("miss")
+        elif not self._check_expired(key):
             self.move_to_end(key)
+            self._count("hit")
         return super().get(key, default)
 
     def set(self, key, value):
@@ -47,3 +77,204 @@ class Cache(OrderedDict):
         result = super().pop(key)
         self._ages.pop(key)
         return result
+
+
+class SQLiteCache:
+    """LRU Cache with get/set, stored in a SQLite database
+
+    Can be shared by many processes - e.g. several uvicorn workers - and
+    survives restarts. Several caches can share a database file, as long as
+    they have different names. Values must be JSON serializable.
+
+    Ages are measured with the wall clock, as they are compared across
+    processes.
+
+    Caches are used synchronously from the event loop, so queries block it.
+    They are small and indexed, so what bounds how long that can take is
+    busy_timeout - how many seconds we wait for another process holding the
+    database lock. If that isn't enough, reads are cache misses, and writes
+    are skipped. The database is only opened on first use in each process,
+    with the same timeout, so importing modules with caches never waits.
+    """
+
+    # Only record accesses this often (in seconds) per key,
+    # so cache hits don't usually need a write
+    access_resolution = 60
+
+    busy_timeout = 0.01
+
+    def __init__(self, path, name, max_size=1024, max_age=0):
+        self.path = path
+        self.name = name
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = None
+        # Process the connection was opened in, as connections can't be
+        # shared with forked children
+        self._pid = None
+
+    def _get_db(self):
+        """
+        Return connection to the database, opening it if needed.
+
+        Must be called with self._lock held. Raises sqlite3.Error if the
+        database can't be set up, in which case the next call tries again.
+        """
+        if self._db is not None and self._pid == os.getpid():
+            return self._db
+        db = sqlite3.connect(
+            self.path, timeout=self.busy_timeout, check_same_thread=False
+        )
+        try:
+            with db:
+                # WAL lets readers in other processes carry on while we write
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute("""
+                    CREATE TABLE IF NOT EXISTS cache (
+                        name TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        created REAL NOT NULL,
+                        accessed REAL NOT NULL,
+                        PRIMARY KEY (name, key)
+                    )
+                    """)
+                db.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (name, accessed)"
+                )
+        except sqlite3.Error:
+            db.close()
+            raise
+        self._db = db
+        self._pid = os.getpid()
+        return db
+
+    def _now(self):
+        return time.time()
+
+    def __len__(self):
+        try:
+            with self._lock:
+                (count,) = (
+                    self._get_db()
+                    .execute("SELECT COUNT(*) FROM cache WHERE name = ?", (self.name,))
+                    .fetchone()
+                )
+        except sqlite3.Error as e:
+            log.warning(f"Failed to count items in cache {self.name}: {e}")
+            return 0
+        return count
+
+    def __contains__(self, key):
+        value, _ = self._lookup(key)
+        return value is not _missing
+
+    def _lookup(self, key):
+        """
+        Return (value, event) for key, without counting the event.
+
+        value is _missing if key isn't in the cache, and event is hit, miss
+        or expired.
+        """
+        now = self._now()
+        try:
+            with self._lock:
+                db = self._get_db()
+                row = db.execute(
+                    "SELECT value, created, accessed FROM cache"
+                    " WHERE name = ? AND key = ?",
+                    (self.name, key),
+                ).fetchone()
+                if row is None:
+                    return _missing, "miss"
+                value, created, accessed = row
+                if self.max_age and created + self.max_age < now:
+                    with db:
+                        db.execute(
+                            "DELETE FROM cache WHERE name = ? AND key = ?",
+                            (self.name, key),
+                        )
+                    return _missing, "expired"
+                if accessed + self.access_resolution < now:
+                    try:
+                        with db:
+                            db.execute(
+                                "UPDATE cache SET accessed = ? WHERE name = ? AND key = ?",
+                                (now, self.name, key),
+                            )
+                    except sqlite3.OperationalError:
+                        # Locked by someone else, so record the access next time
+                        pass
+        except sqlite3.Error as e:
+            # A cache miss is always safe
+            log.warning(f"Failed to read {key} from cache {self.name}: {e}")
+            return _missing, "miss"
+        return json.loads(value), "hit"
+
+    def get(self, key, default=None):
+        """Get an item from the cache
+
+        same as dict.get
+        """
+        value, event = self._lookup(key)
+        CACHE_EVENTS.labels(cache=self.name, event=event).inc()
+        if value is _missing:
+            return default
+        return value
+
+    def set(self, key, value):
+        """Store an item in the cache
+
+        - if already there, moves to the most recent
+        - if full, delete the least recently used items
+        """
+        now = self._now()
+        try:
+            with self._lock:
+                db = self._get_db()
+                with db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO cache (name, key, value, created, accessed)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (self.name, key, json.dumps(value), now, now),
+                    )
+                    db.execute(
+                        """
+                        DELETE FROM cache WHERE name = ? AND key IN (
+                            SELECT key FROM cache WHERE name = ?
+                            ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                        )
+                        """,
+                        (self.name, self.name, self.max_size),
+                    )
+        except sqlite3.Error as e:
+            log.warning(f"Failed to write {key} to cache {self.name}: {e}")
+
+    def pop(self, key):
+        value, _ = self._lookup(key)
+        if value is _missing:
+            raise KeyError(key)
+        try:
+            with self._lock:
+                db = self._get_db()
+                with db:
+                    db.execute(
+                        "DELETE FROM cache WHERE name = ? AND key = ?", (self.name, key)
+                    )
+        except sqlite3.Error as e:
+            log.warning(f"Failed to remove {key} from cache {self.name}: {e}")
+        return value
+
+
+def make_cache(name, max_size=1024, max_age=0):
+    """Make a cache for use by content providers
+
+    Caches are kept in memory, unless REPOPROVIDERS_CACHE_PATH is set to
+    the path of a SQLite database to share them through.
+    """
+    path = os.environ.get("REPOPROVIDERS_CACHE_PATH")
+    if path:
+        return SQLiteCache(path, name, max_size=max_size, max_age=max_age)
+    return Cache(max_size=max_size, max_age=max_age, name=name)
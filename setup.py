@@ -17,7 +17,14 @@ setup(
         "jupyterlite-xeus-python",
         "jupyter-repo2docker",
         "yarl",
+        "prometheus_client",
+        "brotli",
     ],
+    extras_require={
+        "tracing": ["opentelemetry-api"],
+        "s3": ["boto3"],
+        "curl": ["pycurl"],
+    },
     python_requires=">=3.10",
     author="Yuvi Panda",
     author_email="yuvipanda@gmail.com",